@@ -0,0 +1,539 @@
+#!/usr/bin/python3.11
+#-*- coding: utf-8 -*-
+
+"""
+Asyncio client for BaseX. Speaks the same server protocol as `basex.Session`, over asyncio streams.
+It frees the event loop while a request waits for the server; it does not multiplex requests over a connection.
+Every session serializes its own requests, so as many queries are in flight as there are sessions (connections).
+
+Documentation: https://docs.basex.org/wiki/Server_Protocol
+"""
+
+
+from logging import getLogger, basicConfig, DEBUG
+log = getLogger(__name__)
+
+if __name__ == '__main__':
+	basicConfig(level=DEBUG, format='%(asctime)-8s %(levelname)-8s %(name)-32s %(message)s')
+	
+	import warnings
+	warnings.filterwarnings('ignore')
+
+
+__all__ = 'AsyncSession', 'AsyncQuery'
+
+
+import socket
+import asyncio
+from inspect import isasyncgenfunction
+
+if __name__ == '__main__':
+	from basex import Session, Query, BaseXAuthError, BaseXQueryError, BaseXCommandError, BaseXProtocolError
+else:
+	from .basex import Session, Query, BaseXAuthError, BaseXQueryError, BaseXCommandError, BaseXProtocolError
+
+
+def locked(old_method):
+	if isasyncgenfunction(old_method):
+		async def new_method(self, *args, **kwargs):
+			async with self.lock:
+				items = old_method(self, *args, **kwargs)
+				try:
+					async for item in items:
+						yield item
+				finally:
+					await items.aclose() # finish the request before the lock is released
+	else:
+		async def new_method(self, *args, **kwargs):
+			async with self.lock:
+				return await old_method(self, *args, **kwargs)
+	new_method.__name__ = old_method.__name__
+	return new_method
+
+
+class AsyncSession:
+	"""
+	BaseX session on asyncio streams. Maintains connection to the server.
+	
+	Use through the async context manager:
+	```
+		async with AsyncSession('user', 'password', ('::1', 1984)) as session:
+			print(await session.execute.info())
+			async for typeid, item in session.query("XQUERY..."):
+				process_one(item)
+	```
+	
+	User API mirrors `basex.Session`, with all methods being coroutines:
+		execute.COMMAND(*arguments) - execute a server command
+		create(name, input_='') - create a database, and optionally create the default data
+		add(name, path, input_) - add new data to database at the specified path
+		put(path, input_) - add or replace data in previously opened database
+		query(query) - perform XQuery
+	
+	A session handles one request at a time: the server answers the requests of a connection in order,
+	and a result stream occupies the connection until it is read out. Coroutines sharing a session wait for each other.
+	"""
+	
+	terminator = Session.terminator
+	stream_limit = 1 << 20
+	
+	def __init__(self, user, password, address, family=socket.AF_INET6, tls_context=None):
+		"Setup session parameters with host, port, user name and password."
+		self.user = user
+		self.password = password
+		self.address = address
+		self.family = family
+		self.tls_context = tls_context
+	
+	async def open(self):
+		"Open network connection to the server."
+		host, port = self.address[:2]
+		self.__reader, self.__writer = await asyncio.open_connection(host, port, family=self.family, ssl=self.tls_context, limit=self.stream_limit)
+		self.lock = asyncio.Lock()
+	
+	md5 = staticmethod(Session.md5)
+	
+	@locked
+	async def login(self):
+		"Log in. Must be the first method called after open."
+		try:
+			realm, nonce = (await self.recv_str()).split(':')
+		except ValueError:
+			raise BaseXProtocolError("Error in login protocol.")
+		
+		self.send_str(self.user)
+		self.send_str(self.md5(self.md5(':'.join([self.user, realm, self.password])) + nonce))
+		await self.flush()
+		
+		status = await self.recv_byte()
+		if status == 0x0:
+			return
+		elif status == 0x1:
+			raise BaseXAuthError(f"Access denied for user {self.user}", self.user)
+		else:
+			raise BaseXProtocolError(f"Expected status byte 0 or 1, got {hex(status)} instead.")
+	
+	async def logout(self):
+		"Inform the server that the session ended. The server will close the connection at its side."
+		await self._COMMAND('EXIT')
+	
+	async def close(self):
+		"Close network connection to the server."
+		self.__writer.close()
+		try:
+			await self.__writer.wait_closed()
+		except OSError:
+			pass
+		del self.__reader, self.__writer
+		del self.lock
+	
+	def send_byte(self, b):
+		"Buffer one byte for sending. The argument must be 0 <= b < 256."
+		if not 0 <= b < 256:
+			raise ValueError("Argument outside byte range.")
+		self.__writer.write(bytes([b]))
+	
+	def send_str(self, s):
+		"Buffer a string for sending."
+		self.__writer.writelines([s.encode('utf-8'), self.terminator])
+	
+	async def flush(self):
+		"Wait until the written data has been handed to the transport."
+		await self.__writer.drain()
+	
+	async def recv_byte(self):
+		"Receive one byte."
+		try:
+			return (await self.__reader.readexactly(1))[0]
+		except asyncio.IncompleteReadError:
+			raise BaseXProtocolError("Connection closed by the server.")
+	
+	async def recv_str(self):
+		"Receive a string. Strings longer than the stream buffer limit are read in parts."
+		parts = []
+		try:
+			while True:
+				try:
+					part = await self.__reader.readuntil(self.terminator)
+				except asyncio.LimitOverrunError as error:
+					parts.append(await self.__reader.readexactly(error.consumed))
+				else:
+					parts.append(part)
+					break
+		except asyncio.IncompleteReadError:
+			raise BaseXProtocolError("Connection closed by the server.")
+		
+		if len(parts) == 1:
+			return parts[0][:-1].decode('utf-8')
+		else:
+			return bytes().join(parts)[:-1].decode('utf-8')
+	
+	async def __aenter__(self):
+		"Enter context manager. Open connection to the server, log in, return an active session."
+		await self.open()
+		try:
+			await self.login()
+		except:
+			await self.close()
+			raise
+		return self
+	
+	async def __aexit__(self, e_type, e_val, e_stack):
+		"Exit context manager. If the exit was clean, log out. Close the connection."
+		if e_type == None and e_val == None and e_stack == None:
+			await self.logout()
+		await self.close()
+	
+	async def __status(self, method, *args):
+		"Read the trailing status byte of a reply, and the error message if the status says so."
+		status = await self.recv_byte()
+		if status == 0x0:
+			return
+		elif status == 0x1:
+			info = await self.recv_str()
+			raise BaseXQueryError(info, method, *args)
+		else:
+			raise BaseXProtocolError(f"Expected status byte 0 or 1, got {hex(status)} instead.")
+	
+	@locked
+	async def _COMMAND(self, command):
+		"Executes a database command."
+		
+		log.info(f"BaseX command: {command}")
+		self.send_str(command)
+		await self.flush()
+		
+		result = await self.recv_str()
+		info = await self.recv_str()
+		status = await self.recv_byte()
+		
+		if status == 0x0:
+			return result
+		elif status == 0x1:
+			raise BaseXCommandError(info, "COMMAND", command)
+		else:
+			raise BaseXProtocolError(f"Expected status byte 0 or 1, got {hex(status)} instead.")
+	
+	@locked
+	async def _QUERY(self, query):
+		"Creates a new query instance and returns its id."
+		
+		log.info(f"BaseX create xquery.")
+		log.debug('\n\t'.join(query.split('\n')) + '\n')
+		self.send_byte(0x0)
+		self.send_str(query)
+		await self.flush()
+		
+		id_ = await self.recv_str()
+		await self.__status("QUERY", query)
+		return id_
+	
+	async def __input_command(self, code, name, *args):
+		"Common part of CREATE, ADD and PUT: send the arguments, read info and status."
+		self.send_byte(code)
+		for arg in args:
+			self.send_str(arg)
+		await self.flush()
+		
+		info = await self.recv_str()
+		status = await self.recv_byte()
+		if status == 0x0:
+			return
+		elif status == 0x1:
+			raise BaseXCommandError(info, name, *args)
+		else:
+			raise BaseXProtocolError(f"Expected status byte 0 or 1, got {hex(status)} instead.")
+	
+	@locked
+	async def _CREATE(self, name, input_=''):
+		"Creates a new database with the specified input (may be empty)."
+		log.info(f"BaseX create database: {name}, input length: {len(input_)}")
+		await self.__input_command(0x8, "CREATE", name, input_)
+	
+	@locked
+	async def _ADD(self, name, path, input_):
+		"Adds a new document to the opened database."
+		log.info(f"BaseX add XML file: database: {name}, path: {path}, input length: {len(input_)}")
+		await self.__input_command(0x9, "ADD", name, path, input_)
+	
+	@locked
+	async def _PUT(self, path, input_):
+		"Puts (adds or replaces) an XML document resource in the opened database."
+		log.info(f"BaseX put XML file: {path}, input length: {len(input_)}")
+		await self.__input_command(0xc, "PUT", path, input_)
+	
+	@locked
+	async def _CLOSE(self, id_):
+		"Closes and unregisters the query with the specified id."
+		
+		log.info(f"BaseX close xquery {id_}")
+		self.send_byte(0x2)
+		self.send_str(str(id_))
+		await self.flush()
+		
+		await self.recv_str()
+		await self.__status("CLOSE", id_)
+	
+	@locked
+	async def _BIND(self, id_, name, value, type_):
+		"Binds a value to a variable. The type will be ignored if the string is empty."
+		
+		log.info(f"BaseX bind xquery variable: id: {id_}, {name} := {value}, type:{type_}")
+		self.send_byte(0x3)
+		self.send_str(str(id_))
+		self.send_str(name)
+		self.send_str(value)
+		self.send_str(type_)
+		await self.flush()
+		
+		zero = await self.recv_byte()
+		if zero != 0x0:
+			raise BaseXProtocolError(f"Expected zero byte, got {hex(zero)} instead.")
+		await self.__status("BIND", id_, name, value, type_)
+	
+	@locked
+	async def _CONTEXT(self, id_, value, type_):
+		"Binds a value to the context. The type will be ignored if the string is empty."
+		
+		self.send_byte(0xe)
+		self.send_str(str(id_))
+		self.send_str(value)
+		self.send_str(type_)
+		await self.flush()
+		
+		zero = await self.recv_byte()
+		if zero != 0x0:
+			raise BaseXProtocolError(f"Expected zero byte, got {hex(zero)} instead.")
+		await self.__status("CONTEXT", id_, value, type_)
+	
+	@locked
+	async def _RESULTS(self, id_):
+		"Yields all resulting items as strings, prefixed by a single byte that represents the Type ID."
+		
+		log.info(f"BaseX iterate through xquery results {id_}")
+		self.send_byte(0x4)
+		self.send_str(str(id_))
+		await self.flush()
+		
+		reply = self.__results_reply(id_)
+		try:
+			async for item in reply:
+				yield item
+		except GeneratorExit:
+			async for item in reply: # the caller stopped early, read out the rest to keep the protocol stream in sync
+				pass
+			raise
+	
+	async def __results_reply(self, id_):
+		typeid = await self.recv_byte()
+		while typeid != 0x0:
+			item = await self.recv_str()
+			yield typeid, item
+			typeid = await self.recv_byte()
+		
+		await self.__status("RESULTS", id_)
+	
+	async def __string_request(self, code, name, id_):
+		"Common part of EXECUTE, INFO, OPTIONS and UPDATING: one string result followed by status."
+		self.send_byte(code)
+		self.send_str(str(id_))
+		await self.flush()
+		
+		result = await self.recv_str()
+		await self.__status(name, id_)
+		return result
+	
+	@locked
+	async def _EXECUTE(self, id_):
+		"Executes the query and returns the result as a single string."
+		log.info(f"BaseX execute xquery {id_}")
+		return await self.__string_request(0x5, "EXECUTE", id_)
+	
+	@locked
+	async def _INFO(self, id_):
+		"Returns a string with query compilation and profiling info."
+		return await self.__string_request(0x6, "INFO", id_)
+	
+	@locked
+	async def _OPTIONS(self, id_):
+		"Returns a string with all query serialization parameters."
+		return await self.__string_request(0x7, "OPTIONS", id_)
+	
+	@locked
+	async def _UPDATING(self, id_):
+		"Returns true if the query contains updating expressions; false otherwise."
+		return await self.__string_request(0x1e, "UPDATING", id_)
+	
+	create = _CREATE
+	add = _ADD
+	put = _PUT
+	
+	def query(self, query):
+		"Return an XQuery helper."
+		return AsyncQuery(self, query)
+	
+	@property
+	def execute(self):
+		"Return command helper."
+		return AsyncCommand(self)
+
+
+class AsyncCommand:
+	"Helper class for making server commands, see `basex.Command`. The returned callables are coroutine functions."
+	
+	def __init__(self, session):
+		self.__session = session
+	
+	def __getattr__(self, attr):
+		return lambda *args: self.__session._COMMAND(' '.join([attr.upper().replace('_', ' ').strip()] + [str(_arg) for _arg in args]))
+
+
+class AsyncQuery:
+	"""
+	XQuery manager class for `AsyncSession`, see `basex.Query`.
+	
+	```
+		async with session.query("XQUERY...") as query:
+			await query.bind('$a', 1)
+			result = await query.execute()
+			
+			async for typeid, item in query.results():
+				process_one(item)
+		
+		# all-in-one helpers
+		result = await session.query("XQUERY...")()
+		async for typeid, item in session.query("XQUERY..."):
+			process_one(item)
+	```
+	"""
+	
+	typeids = Query.typeids
+	
+	def __init__(self, session, query):
+		"Initialize the Query object with a session and query string."
+		self.session = session
+		self.query = query
+	
+	def is_open(self):
+		return hasattr(self, 'id_')
+	
+	async def open(self):
+		"Sends the query and creates the underlying resources on the server. Returns the query id created by the server."
+		if hasattr(self, 'id_'):
+			raise ValueError("Query already active.")
+		self.id_ = int(await self.session._QUERY(self.query))
+		log.info(f"Opened xquery id {self.id_}")
+		return self.id_
+	
+	async def close(self):
+		"Closes the query and frees the resources on the server."
+		if not hasattr(self, 'id_'):
+			raise ValueError("Query not in active state.")
+		await self.session._CLOSE(self.id_)
+		del self.id_
+	
+	async def execute(self):
+		"Return the result of the query as one big string."
+		return await self.session._EXECUTE(self.id_)
+	
+	async def results(self):
+		"Yield results one by one as (typeid, value). Close the generator (`aclose`) when stopping early, so the session is free again at once."
+		results = self.session._RESULTS(self.id_)
+		try:
+			async for typeid, value in results:
+				try:
+					typestr = self.typeids[typeid]
+				except IndexError:
+					typestr = None
+				yield typestr, value
+		finally:
+			await results.aclose()
+	
+	async def info(self):
+		"Return compilation and profiling info of this query."
+		return await self.session._INFO(self.id_)
+	
+	async def options(self):
+		"Return query serialization parameters."
+		return await self.session._OPTIONS(self.id_)
+	
+	async def updating(self):
+		"Check if this query is updating (writing) resources, or is read-only."
+		return (await self.session._UPDATING(self.id_)) == 'true'
+	
+	async def bind(self, name, value, type_=''):
+		"Bind a value to an external variable declared in the query."
+		return await self.session._BIND(self.id_, name, str(value), type_)
+	
+	async def context(self, value, type_=''):
+		return await self.session._CONTEXT(self.id_, value, type_)
+	
+	async def __aenter__(self):
+		"Enter context manager. Use as alternative to open/close."
+		await self.open()
+		return self
+	
+	async def __aexit__(self, *args):
+		"Exit context manager. Use as alternative to open/close."
+		await self.close()
+	
+	async def __call__(self):
+		"All-in-one convenience function. Open the query, execute, return all results as one big string, close."
+		await self.open()
+		try:
+			return await self.execute()
+		finally:
+			await self.close()
+	
+	async def __aiter__(self):
+		"All-in-one convenience function. Open the query, yield results one by one prefixed by typeid, close."
+		await self.open()
+		try:
+			results = self.results()
+			try:
+				async for item in results:
+					yield item
+			finally:
+				await results.aclose()
+		finally:
+			await self.close()
+
+
+if __debug__ and __name__ == '__main__':
+	from fakeserver import FakeServer
+	
+	async def check_early_exit():
+		with FakeServer(query=lambda _text, _bindings, _context: range(100)) as server:
+			async with AsyncSession('admin', 'admin', server.address) as session:
+				for n in range(3):
+					items = session.query('items').__aiter__()
+					async for typeid, item in items:
+						break
+					await items.aclose()
+					
+					async with session.query('items') as query:
+						results = query.results()
+						assert await results.__anext__() == ('xs:string', '0')
+						await results.aclose()
+						assert await query.execute() == '\n'.join(str(_n) for _n in range(100)) # the stream is still in sync
+	
+	asyncio.run(check_early_exit())
+	print("check_early_exit: ok")
+	
+	async def main():
+		async with AsyncSession('db_user', 'wemn2o03289', ('::1', 1984)) as session:
+			print(await session.execute.info())
+			print(await session.query('1 to 5')())
+			async for item in session.query('1 to 5'):
+				print(item)
+		
+		sessions = [AsyncSession('db_user', 'wemn2o03289', ('::1', 1984)) for _n in range(4)]
+		for session in sessions:
+			await session.__aenter__()
+		try:
+			print(await asyncio.gather(*[sessions[_n % len(sessions)].query(f'{_n} * 2')() for _n in range(100)]))
+		finally:
+			for session in sessions:
+				await session.__aexit__(None, None, None)
+	
+	asyncio.run(main())
@@ -5,12 +5,6 @@
 Python 3.6+ client for BaseX.
 Works with BaseX 8.2 and later
 
-LIMITATIONS:
-
-* binary content would corrupt, maybe. (I didn't test it)
-* also, will fail to extract stored binary content, maybe.
-  (both my code, and original don't care escaped 0xff.)
-
 Documentation: https://docs.basex.org/wiki/Clients
 
 (C) 2012, Hiroaki Itoh. BSD License
@@ -30,25 +24,196 @@ if __name__ == '__main__':
 	warnings.filterwarnings('ignore')
 
 
-__all__ = 'BaseXError', 'BaseXAuthError', 'BaseXQueryError', 'BaseXCommandError', 'BaseXProtocolError', 'Session', 'Query'
+__all__ = 'BaseXError', 'BaseXAuthError', 'BaseXQueryError', 'BaseXCommandError', 'BaseXProtocolError', 'BaseXTimeoutError', 'Session', 'SessionPool', 'Reply', 'Spool', 'Item', 'Statistics', 'ResultCache', 'Query'
 
 
+import os
+import io
+import re
 import socket
-from collections import deque
+import ssl
+from mmap import mmap, ACCESS_READ
+from tempfile import TemporaryFile
+from select import select
+from time import monotonic, perf_counter
+from bisect import bisect_right
+from heapq import heappush, heappop, heapify
+from collections import deque, OrderedDict
+from itertools import islice
 from hashlib import md5
 from multiprocessing import Lock
+from threading import get_ident, Condition, Thread, Event, RLock
+from queue import Queue, Empty
 from inspect import isgeneratorfunction
+from contextlib import contextmanager
+from codecs import getincrementaldecoder
+
+
+utf8_decoder = getincrementaldecoder('utf-8')
+
+
+def escape(data):
+	"Escape 0x00 and 0xFF bytes with 0xFF, as the protocol requires for raw data. Data without such bytes is returned as it is, without a copy."
+	return data.replace(b'\xff', b'\xff\xff').replace(b'\x00', b'\xff\x00')
+
+
+escaped_data = re.compile(rb'(?:[^\x00\xff]+|\xff.)*', re.S)
+escape_sequence = re.compile(rb'\xff(.)', re.S)
+
+
+def unescape(data):
+	"Reverse `escape`. Data without escapes is returned as it is."
+	if b'\xff' not in data:
+		return data
+	return escape_sequence.sub(rb'\1', data)
+
+
+def document_chunks(input_, chunk_size):
+	"""
+	Yield the data of a document as `bytes`, in parts of about `chunk_size`. The input may be a `str` or `bytes` holding the document,
+	a path (`os.PathLike`, e.g. `pathlib.Path`; a plain `str` is the document itself), a text or binary file object, or an iterable of `str`/`bytes` parts.
+	"""
+	if isinstance(input_, str):
+		for start in range(0, len(input_), chunk_size):
+			yield input_[start:start + chunk_size].encode('utf-8')
+	elif isinstance(input_, (bytes, bytearray, memoryview)):
+		with memoryview(input_) as view:
+			for start in range(0, len(view), chunk_size):
+				yield bytes(view[start:start + chunk_size])
+	elif isinstance(input_, os.PathLike):
+		with open(input_, 'rb') as file_:
+			yield from document_chunks(file_, chunk_size)
+	elif hasattr(input_, 'read'):
+		while chunk := input_.read(chunk_size):
+			yield chunk.encode('utf-8') if isinstance(chunk, str) else bytes(chunk)
+	else:
+		for chunk in input_:
+			yield chunk.encode('utf-8') if isinstance(chunk, str) else bytes(chunk)
+
+
+fork_generation = 0
+
+def count_fork():
+	global fork_generation
+	fork_generation += 1
+
+if hasattr(os, 'register_at_fork'):
+	os.register_at_fork(after_in_child=count_fork)
 
 
 def locked(old_method):
+	"""
+	Hold the session lock for the duration of the method. In pipeline mode the lock is already held on behalf of the owner thread.
+	A session used for the first time in a forked child reconnects first (see `Session.after_fork`), as does a cancelled one (see `Session.cancel`).
+	While a generator method streams results, the session is marked busy for its thread: a nested call from that thread
+	would deadlock, so it raises instead. Use `Session.borrow` (or `Session.query`, `Session.execute`), which switch to a side connection.
+	If the session collects statistics, the call goes through `measured` instead.
+	"""
+	
 	if isgeneratorfunction(old_method):
 		def new_method(self, *args, **kwargs):
-			with self.lock:
+			if self.generation != fork_generation or self.cancelled:
+				self.check_process()
+			if self.statistics is not None:
+				yield from measured_stream(self, old_method, args, kwargs)
+			elif self.pipeline_owner == get_ident():
 				yield from old_method(self, *args, **kwargs)
+			else:
+				if self.stream_owner == get_ident():
+					raise BaseXProtocolError(f"Nested use of a session with an open result stream ({old_method.__name__}).")
+				with self.lock:
+					self.stream_owner = get_ident()
+					try:
+						yield from old_method(self, *args, **kwargs)
+					finally:
+						self.stream_owner = None
 	else:
 		def new_method(self, *args, **kwargs):
-			with self.lock:
+			if self.generation != fork_generation or self.cancelled:
+				self.check_process()
+			if self.statistics is not None:
+				return measured(self, old_method, args, kwargs)
+			elif self.pipeline_owner == get_ident():
 				return old_method(self, *args, **kwargs)
+			else:
+				if self.stream_owner == get_ident():
+					raise BaseXProtocolError(f"Nested use of a session with an open result stream ({old_method.__name__}).")
+				with self.lock:
+					return old_method(self, *args, **kwargs)
+	new_method.__name__ = old_method.__name__
+	return new_method
+
+
+def measured(self, method, args, kwargs):
+	"The body of a `locked` method, recording the call in `self.statistics`: lock wait, duration, bytes transferred, failure."
+	start = perf_counter()
+	lock = None
+	if self.pipeline_owner == get_ident():
+		acquired = start
+	elif self.stream_owner == get_ident():
+		raise BaseXProtocolError(f"Nested use of a session with an open result stream ({method.__name__}).")
+	else:
+		lock = self.lock
+		lock.acquire()
+		acquired = perf_counter()
+	
+	sent, received = self.transferred()
+	failed = True
+	try:
+		result = method(self, *args, **kwargs)
+		failed = False
+		return result
+	finally:
+		finished = perf_counter()
+		sent_after, received_after = self.transferred()
+		self.statistics.record(method.__name__, acquired - start, finished - acquired, sent_after - sent, received_after - received, failed)
+		if lock is not None:
+			lock.release()
+
+
+def measured_stream(self, method, args, kwargs):
+	"The body of a `locked` generator method, recording the call in `self.statistics`. The duration includes the consumer's time between the items."
+	start = perf_counter()
+	lock = None
+	if self.pipeline_owner == get_ident():
+		acquired = start
+	elif self.stream_owner == get_ident():
+		raise BaseXProtocolError(f"Nested use of a session with an open result stream ({method.__name__}).")
+	else:
+		lock = self.lock
+		lock.acquire()
+		acquired = perf_counter()
+		self.stream_owner = get_ident()
+	
+	sent, received = self.transferred()
+	failed = True
+	try:
+		yield from method(self, *args, **kwargs)
+		failed = False
+	finally:
+		finished = perf_counter()
+		sent_after, received_after = self.transferred()
+		self.statistics.record(method.__name__, acquired - start, finished - acquired, sent_after - sent, received_after - received, failed)
+		if lock is not None:
+			self.stream_owner = None
+			lock.release()
+
+
+def pipelined(old_method):
+	"""
+	Protocol method that may be queued in pipeline mode (see `Session.pipeline`).
+	The method is written as a generator: the bare `yield` separates writing the request from reading the reply.
+	Outside of pipeline mode the request is flushed and the result is returned immediately, otherwise a `Reply` is returned.
+	"""
+	
+	def new_method(self, *args, **kwargs):
+		exchange = old_method(self, *args, **kwargs)
+		next(exchange)
+		reply = self.enqueue(exchange)
+		if self.pipeline_owner == get_ident():
+			return reply
+		else:
+			return reply.result()
 	new_method.__name__ = old_method.__name__
 	return new_method
 
@@ -73,6 +238,96 @@ class BaseXProtocolError(BaseXError):
 	"Error related to network protocol."
 
 
+class BaseXTimeoutError(BaseXError, TimeoutError):
+	"A request did not complete before its deadline and was cancelled."
+
+
+class Watchdog:
+	"""
+	Runs actions at their deadlines, for `Session.deadline`: one background thread and one heap of deadlines for all sessions.
+	An action that comes due gets a thread of its own, as cancelling a session opens a new connection, which must not hold up the other deadlines.
+	The thread starts on first use, again in a forked child.
+	"""
+	
+	class Entry:
+		__slots__ = 'when', 'action', 'state' # state: 'pending', 'cancelled', 'running' or 'done'
+		
+		def __init__(self, when, action):
+			self.when = when
+			self.action = action
+			self.state = 'pending'
+		
+		def __lt__(self, other):
+			return self.when < other.when
+	
+	def __init__(self):
+		self.generation = None
+		self.starting = RLock()
+	
+	def __reset(self):
+		self.generation = fork_generation
+		self.condition = Condition()
+		self.heap = []
+		self.cancelled = 0 # entries left in the heap until they come up
+		Thread(target=self.run, name='deadline-watchdog', daemon=True).start()
+	
+	def schedule(self, timeout, action):
+		"Call `action()` after `timeout` seconds, unless cancelled before. Return the entry to pass to `cancel`."
+		if self.generation != fork_generation:
+			with self.starting:
+				if self.generation != fork_generation:
+					self.__reset()
+		entry = self.Entry(monotonic() + timeout, action)
+		with self.condition:
+			heappush(self.heap, entry)
+			if self.heap[0] is entry:
+				self.condition.notify_all()
+		return entry
+	
+	def cancel(self, entry):
+		"Cancel the action of `entry`. If it has come due, wait until it is finished. Return True if it ran, False if it was cancelled in time."
+		with self.condition:
+			if entry.state == 'pending':
+				entry.state = 'cancelled'
+				self.cancelled += 1
+				if self.cancelled > len(self.heap) // 2: # many deadlines far ahead, cancelled early
+					self.heap = [_entry for _entry in self.heap if _entry.state == 'pending']
+					heapify(self.heap)
+					self.cancelled = 0
+				return False
+			while entry.state == 'running':
+				self.condition.wait()
+			return True
+	
+	def run(self):
+		condition = self.condition
+		with condition:
+			while True:
+				while self.heap and self.heap[0].state == 'cancelled':
+					heappop(self.heap)
+					self.cancelled -= 1
+				if not self.heap:
+					condition.wait()
+					continue
+				delay = self.heap[0].when - monotonic()
+				if delay > 0:
+					condition.wait(delay)
+					continue
+				entry = heappop(self.heap)
+				entry.state = 'running'
+				Thread(target=self.fire, args=(entry,), name='deadline-expired', daemon=True).start()
+	
+	def fire(self, entry):
+		try:
+			entry.action()
+		except Exception as error:
+			log.warning(f"Deadline action failed: {error}")
+		finally:
+			with self.condition:
+				entry.state = 'done'
+				self.condition.notify_all()
+
+
 class Session:
 	"""
 	BaseX session. Maintains connection to the server.
@@ -88,126 +343,391 @@ class Session:
 		add(name, path, input_) - add new data to database at the specified path
 		put(path, input_) - add or replace data in previously opened database
 		put_binary(path, input_) - upload binary data to previously opened database
+		retrieve(path, sink=None) - download binary data from previously opened database, into `sink` if given
+		retrieve_into(path, buffer) - download binary data into a preallocated buffer
+		stats(reset=False) - protocol statistics, if the session collects them
 		query(query) - perform XQuery
+		borrow() - context manager giving a session usable from the current thread, even while it iterates over results of this one
+		pipeline() - context manager that queues BIND, CONTEXT, EXECUTE and CLOSE requests and sends them together
+	
+	If `memory_limit` (in bytes) is set, a command or query result (or a result item) bigger than that is not returned as a string,
+	but spilled to a temporary file and returned as a `Spool`.
+	
+	With `statistics`, every protocol call is measured, see `stats()` and `Statistics`.
 	"""
 	
 	terminator = bytes([0])
+	watchdog = Watchdog()
+	upload_flush_size = 1 << 20
+	exchange_size = 1 << 16 # bigger pipelines read the replies while they are being sent, see `SocketWrapper.flush`
 	
 	class SocketWrapper:
 		class Buffer:
+			"Send buffer. Keeps the queued chunks as they are, so they can be written out without concatenating them."
+			
 			def __init__(self):
 				self.data = deque()
 				self.length = 0
 			
 			def __len__(self):
-				assert self.length == sum(len(_s) for _s in self.data)
 				return self.length
 			
-			def __contains__(self, ch):
-				return any(ch in _s for _s in self.data)
-			
 			def __bytes__(self):
 				return bytes().join(self.data)
 			
-			def index(self, ch):
-				pos = 0
-				for s in self.data:
-					try:
-						pos += s.index(ch)
-						return pos
-					except ValueError:
-						pos += len(s)
-				else:
-					raise IndexError
+			def clear(self):
+				"Drop all the queued data."
+				self.data.clear()
+				self.length = 0
 			
-			def get(self, n):
+			def skip(self, n):
+				"Drop `n` bytes from the front of the buffer. A partially consumed chunk is replaced by a view of its remainder."
 				if len(self) < n:
 					raise ValueError("Not enough data")
 				
-				if __debug__: orig_length = len(self)
-				
-				result = []
-				result_length = 0
-				while result_length < n:
+				self.length -= n
+				while n:
 					s = self.data[0]
-					needed = n - result_length
-					if len(s) <= needed:
-						result.append(s)
+					if len(s) <= n:
 						del self.data[0]
-						result_length += len(s)
+						n -= len(s)
 					else:
-						result.append(s[:needed])
-						self.data[0] = s[needed:]
-						result_length += needed
-				
-				self.length -= result_length
-				assert result_length == n
-				assert len(self) == orig_length - result_length
-				
-				return bytes().join(result)
+						self.data[0] = memoryview(s)[n:]
+						n = 0
+			
+			def put(self, b):
+				if b:
+					self.data.append(b)
+					self.length += len(b)
+		
+		class InputBuffer:
+			"""
+			Receive buffer. Data is kept in one preallocated `bytearray`, filled through `recv_into` and consumed from the front.
+			Unread data is moved to the beginning when there is no room at the end; the storage grows only if that is not enough.
+			The terminator search remembers how far it got, so every received byte is scanned only once.
+			"""
+			
+			initial_capacity = 1 << 16
+			shrink_capacity = 1 << 24
+			
+			def __init__(self):
+				self.allocate(self.initial_capacity)
+				self.head = 0
+				self.tail = 0
+				self.scanned = 0
+			
+			def allocate(self, capacity):
+				self.data = bytearray(capacity)
+				self.view = memoryview(self.data)
+			
+			def __len__(self):
+				return self.tail - self.head
+			
+			def __bytes__(self):
+				return bytes(self.view[self.head:self.tail])
+			
+			def find(self, ch):
+				"Return the position of the single byte `ch` relative to the buffer start, or -1 if not present yet. Resumes where the previous unsuccessful search stopped."
+				pos = self.data.find(ch, max(self.head, self.scanned), self.tail)
+				if pos < 0:
+					self.scanned = self.tail
+					return -1
+				self.scanned = pos
+				return pos - self.head
+			
+			def match(self, pattern):
+				"Match the compiled regular expression at the buffer start, in place. Return the length of the match."
+				return pattern.match(self.data, self.head, self.tail).end() - self.head
+			
+			def get_view(self, n):
+				"Like `get`, but return a view of the storage instead of a copy. It is valid only until the next read into the buffer."
+				if len(self) < n:
+					raise ValueError("Not enough data")
+				result = self.view[self.head:self.head + n]
+				self.head += n
+				self.scanned = max(self.head, self.scanned)
+				return result
+			
+			def get(self, n):
+				if len(self) < n:
+					raise ValueError("Not enough data")
+				result = bytes(self.view[self.head:self.head + n])
+				self.head += n
+				if self.head == self.tail:
+					self.head = self.tail = self.scanned = 0
+					if len(self.data) > self.shrink_capacity:
+						self.allocate(self.initial_capacity) # drop the storage grown by an exceptionally big response
+				return result
+			
+			def reserve(self, n):
+				"Make room for at least `n` bytes after the end of the data and return a writable view of it."
+				if len(self.data) - self.tail < n:
+					length = len(self)
+					if len(self.data) - length >= n:
+						self.view[:length] = self.view[self.head:self.tail] # memoryview assignment handles the overlap
+					else:
+						capacity = len(self.data)
+						while capacity - length < n:
+							capacity *= 2
+						old_view = self.view[self.head:self.tail]
+						self.allocate(capacity)
+						self.view[:length] = old_view
+						old_view.release()
+					self.scanned = max(0, self.scanned - self.head)
+					self.head = 0
+					self.tail = length
+				return self.view[self.tail:]
+			
+			def commit(self, n):
+				"Mark `n` bytes written into the view returned by `reserve` as valid data."
+				self.tail += n
 			
 			def put(self, b):
-				self.data.append(b)
-				self.length += len(b)
+				self.reserve(len(b))[:len(b)] = b
+				self.commit(len(b))
+		
+		min_read_size = 1 << 12
+		max_read_size = 1 << 20
+		tls_sessions = {} # (TLS context, address) -> the last `ssl.SSLSession` with the server, resumed by the next connection there
 		
 		def __init__(self, address, family=socket.AF_INET6, tls_context=None):
 			self.address = address
 			self.family = family
 			self.tls_context = tls_context
 			
-			self.in_buffer = self.Buffer()
+			self.in_buffer = self.InputBuffer()
 			self.out_buffer = self.Buffer()
+			self.read_size = self.min_read_size
+			self.scatter_gather = hasattr(socket.socket, 'sendmsg')
+			self.sent = 0
+			self.received = 0
 		
 		def open(self):
 			self.__sock = socket.socket(self.family, socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
 			if self.tls_context:
-				self.__sock = self.tls_context.wrap_socket(self.__sock)
+				self.__sock = self.tls_context.wrap_socket(self.__sock, session=self.tls_sessions.get((self.tls_context, tuple(self.address))))
 			self.__sock.connect(self.address)
 		
+		def tls_resumed(self):
+			return self.tls_context is not None and self.__sock.session_reused
+		
+		def keep_tls_session(self):
+			"Remember the TLS session of the connection for the next one to the same address. With TLS 1.3 it is only complete after some data has been received."
+			if self.tls_context:
+				session = self.__sock.session
+				if session is not None:
+					self.tls_sessions[self.tls_context, tuple(self.address)] = session
+		
+		def fill(self):
+			"""
+			Read one portion of data from the socket straight into the input buffer.
+			The read size doubles every time a read fills it completely (a bulk transfer is going on) and drops back to the minimum on a short read.
+			"""
+			read_size = self.read_size
+			with self.in_buffer.reserve(read_size)[:read_size] as free:
+				n = self.__sock.recv_into(free)
+				if not n:
+					raise BaseXProtocolError("Connection closed by the server.")
+				if log.isEnabledFor(DEBUG):
+					log.debug(f"recv: {bytes(free[:n])}")
+			self.in_buffer.commit(n)
+			self.received += n
+			
+			if n == read_size:
+				self.read_size = min(2 * read_size, self.max_read_size)
+			elif n < read_size // 2:
+				self.read_size = self.min_read_size
+		
 		def recv(self, n):
 			while len(self.in_buffer) < n:
-				data = self.__sock.recv(4096)
-				log.debug(f"recv: {data}")
-				self.in_buffer.put(data)
+				self.fill()
 			return self.in_buffer.get(n)
 		
 		def recv_until(self, t):
-			while not t in self.in_buffer:
-				data = self.__sock.recv(4096)
-				log.debug(f"recv: {data}")
-				self.in_buffer.put(data)
-			return self.in_buffer.get(self.in_buffer.index(t))
+			pos = self.in_buffer.find(t)
+			if pos >= 0:
+				return self.in_buffer.get(pos)
+			return b''.join(self.recv_chunks_until(t)) # long data: move it out of the buffer as it arrives, so the buffer stays small
+		
+		def recv_chunks_until(self, t):
+			"Yield the data up to the terminator `t` in parts, as it arrives. The terminator is left in the buffer."
+			while (pos := self.in_buffer.find(t)) < 0:
+				if len(self.in_buffer):
+					yield self.in_buffer.get(len(self.in_buffer))
+				self.fill()
+			if pos:
+				yield self.in_buffer.get(pos)
+		
+		def recv_raw_chunks(self):
+			"Yield the unescaped parts of raw (binary) data as they arrive, up to the terminator, which is consumed. Parts without escapes are views of the input buffer, valid only until the next one is requested."
+			buffer = self.in_buffer
+			while True:
+				data, head, tail = buffer.data, buffer.head, buffer.tail
+				zero = data.find(0, head, tail)
+				end = zero if zero >= 0 else tail
+				if data.find(0xff, head, end) < 0: # no escapes, the zero if any is the terminator
+					if end > head:
+						yield buffer.get_view(end - head)
+					if zero >= 0:
+						buffer.get(1)
+						return
+				else:
+					length = buffer.match(escaped_data) # complete escape sequences only
+					terminated = length < len(buffer) and data[head + length] == 0
+					if length:
+						yield unescape(buffer.get_view(length).tobytes())
+					if terminated:
+						buffer.get(1)
+						return
+				self.fill()
 		
 		def send(self, b):
 			self.out_buffer.put(b)
 		
-		def flush(self):
-			tosend = self.out_buffer.get(len(self.out_buffer))
-			log.debug(f"send: {tosend}")
-			self.__sock.sendall(tosend)
+		try:
+			iov_max = os.sysconf('SC_IOV_MAX')
+		except (AttributeError, ValueError, OSError):
+			iov_max = 1024
+		
+		coalesce_size = 1 << 14
+		would_block = BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError
+		
+		def flush(self, receive=False):
+			"""
+			Write out the whole output buffer. The queued chunks go to the kernel in one `sendmsg` call (partial writes are continued), not joined into one copy first.
+			With `receive`, data arriving meanwhile is read into the input buffer: a server answering earlier requests would otherwise
+			block on a full socket and stop reading, while we block on writing to it.
+			"""
+			if log.isEnabledFor(DEBUG):
+				log.debug(f"send: {bytes(self.out_buffer)}")
+			
+			if receive:
+				self.__exchange()
+				return
+			
+			chunks = self.out_buffer.data
+			if self.scatter_gather:
+				try:
+					while chunks:
+						sent = self.__sock.sendmsg(islice(chunks, self.iov_max))
+						self.out_buffer.skip(sent)
+						self.sent += sent
+					return
+				except NotImplementedError: # SSLSocket
+					self.scatter_gather = False
+			
+			# Fallback without `sendmsg`: small chunks are coalesced up to `coalesce_size`, big ones are sent as they are.
+			while chunks:
+				if len(chunks[0]) >= self.coalesce_size or len(chunks) == 1:
+					tosend = chunks[0]
+				else:
+					batch = []
+					size = 0
+					for chunk in chunks:
+						if size and size + len(chunk) > self.coalesce_size:
+							break
+						batch.append(chunk)
+						size += len(chunk)
+					tosend = bytes().join(batch)
+				self.__sock.sendall(tosend)
+				self.out_buffer.skip(len(tosend))
+				self.sent += len(tosend)
+		
+		def __exchange(self):
+			"Write out the output buffer without blocking, reading whatever arrives in between."
+			sock = self.__sock
+			chunks = self.out_buffer.data
+			timeout = sock.gettimeout()
+			sock.setblocking(False)
+			try:
+				while chunks:
+					readable, writable, _ = select([sock], [sock], [])
+					if readable:
+						try:
+							self.fill()
+						except self.would_block:
+							pass
+					if writable:
+						try:
+							if self.scatter_gather:
+								sent = sock.sendmsg(islice(chunks, self.iov_max))
+							else:
+								sent = sock.send(chunks[0])
+						except self.would_block:
+							continue
+						except NotImplementedError: # SSLSocket
+							self.scatter_gather = False
+							continue
+						self.out_buffer.skip(sent)
+						self.sent += sent
+			finally:
+				sock.settimeout(timeout)
 		
 		def close(self):
 			self.__sock.close()
 			del self.__sock
 		
+		def shutdown(self):
+			"Shut the connection down in both directions, waking up a thread blocked on it. The socket stays to be closed."
+			try:
+				self.__sock.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+		
+		def client_address(self):
+			"Local end of the connection as the server names it in `KILL` and `SHOW SESSIONS`: address in Java notation and port."
+			host, port = self.__sock.getsockname()[:2]
+			host = host.partition('%')[0]
+			if ':' not in host:
+				return f'{host}:{port}'
+			packed = socket.inet_pton(socket.AF_INET6, host)
+			if packed[:12] == bytes(10) + b'\xff\xff': # IPv4-mapped
+				return f'{socket.inet_ntop(socket.AF_INET, packed[12:])}:{port}'
+			return ':'.join(f'{int.from_bytes(packed[_n:_n + 2], "big"):x}' for _n in range(0, 16, 2)) + f':{port}'
+		
+		def is_alive(self):
+			"Check without blocking that the connection is usable: nothing is left in the buffers and the socket is not readable (a readable idle socket means EOF or stray data)."
+			if len(self.in_buffer) or len(self.out_buffer):
+				return False
+			try:
+				readable, _, _ = select([self.__sock], [], [], 0)
+			except (OSError, ValueError):
+				return False
+			return not readable
+		
 		def are_buffers_empty(self):
 			if len(self.in_buffer): log.error(f"Input protocol buffer corrupted: {bytes(self.in_buffer)}")
 			if len(self.out_buffer): log.error(f"Output protocol buffer corrupted: {bytes(self.out_buffer)}")
 			return len(self.in_buffer) == len(self.out_buffer) == 0
 	
-	def __init__(self, user, password, address, family=socket.AF_INET6, tls_context=None):
-		"Setup session parameters with host, port, user name and password."
+	def __init__(self, user, password, address, family=socket.AF_INET6, tls_context=None, memory_limit=None, statistics=False, result_cache=None):
+		"Setup session parameters with host, port, user name and password. See `ResultCache` for `result_cache`."
 		self.user = user
 		self.password = password
 		self.address = address
 		self.family = family
 		self.tls_context = tls_context
+		self.memory_limit = memory_limit
+		self.statistics = Statistics() if statistics else None
+		self.result_cache = result_cache
+		self.pipeline_owner = None
+		self.stream_owner = None
+		self.side = None
+		self.generation = fork_generation
+		self.connections = 0
+		self.cancelled = False
 	
 	def open(self):
 		"Open network connection to the server."
 		self.__swrapper = self.SocketWrapper(self.address, self.family, self.tls_context)
 		self.__swrapper.open()
 		self.lock = Lock()
+		self.generation = fork_generation
+		self.connections += 1
+		self.cancelled = False
+		self.__pending = deque()
+		self.__enqueued_length = 0
+		self.__reply_follows = False
 	
 	@staticmethod
 	def md5(s):
@@ -230,21 +750,117 @@ class Session:
 			raise BaseXProtocolError(f"Garbage left in protocol buffers (login).")
 		
 		if status == 0x0:
+			self.__swrapper.keep_tls_session()
 			return
 		elif status == 0x1:
 			raise BaseXAuthError(f"Access denied for user {self.user}", self.user)
 		else:
 			raise BaseXProtocolError(f"Expected status byte 0 or 1, got {hex(status)} instead.")
 	
+	def check_process(self):
+		"Reconnect if the process has forked since the connection was opened, or the connection has been cancelled."
+		if self.generation != fork_generation:
+			self.after_fork()
+		elif self.cancelled:
+			if get_ident() in (self.pipeline_owner, self.stream_owner): # the lock is held by this thread, for the request that was cancelled
+				raise BaseXProtocolError("Session cancelled.")
+			with self.lock:
+				if self.cancelled:
+					lock = self.lock
+					self.reconnect()
+					self.lock = lock # other threads may be waiting for it
+	
+	def after_fork(self):
+		"""
+		Replace the connection inherited from the parent process by a new one. The inherited socket is only closed locally,
+		as the connection still serves the parent. The lock is replaced too, since the inherited one is shared with the parent.
+		"""
+		self.generation = fork_generation
+		self.reconnect()
+	
+	def reconnect(self):
+		"""
+		Replace the connection by a new one, without logging out of the old one, whose socket is only closed locally.
+		Queries are prepared again on their next use. Subclasses extend this to restore their per-connection state.
+		"""
+		self.pipeline_owner = None
+		self.stream_owner = None
+		try:
+			swrapper = self.__swrapper
+		except AttributeError:
+			return # not open
+		
+		log.info(f"Reconnecting session to {self.address}.")
+		swrapper.close()
+		self.open()
+		self.login()
+	
+	def cancel(self):
+		"""
+		Stop the request in progress, from another thread. The local socket is shut down, so the waiting thread gets an error at once,
+		then a new connection tells the server to `KILL` this session (which needs admin rights, otherwise the query runs on until it tries to send results).
+		The session reconnects on its next use.
+		"""
+		try:
+			swrapper = self.__swrapper
+		except AttributeError:
+			return # not open
+		
+		address = swrapper.client_address()
+		self.cancelled = True
+		swrapper.shutdown()
+		log.warning(f"Cancelling session {address} on {self.address}.")
+		try:
+			with Session(self.user, self.password, self.address, self.family, self.tls_context) as killer:
+				killer._COMMAND(f'KILL {address}')
+		except (BaseXError, OSError) as error:
+			log.info(f"Session {address} not killed on the server: {error}")
+	
+	@contextmanager
+	def deadline(self, timeout):
+		"""
+		Requests made on the session in the block must complete within `timeout` seconds (None for no limit), or the session is cancelled
+		(see `cancel`) and `BaseXTimeoutError` is raised. When the block reads a result stream, the time counts until the stream is finished.
+		
+		```
+			with session.deadline(5.0):
+				result = query.execute()
+		```
+		"""
+		if timeout is None:
+			yield self
+			return
+		
+		entry = self.watchdog.schedule(timeout, self.cancel)
+		try:
+			yield self
+		except (BaseXError, OSError) as error:
+			if self.watchdog.cancel(entry): # waits for a cancellation in progress
+				raise BaseXTimeoutError(f"Request not complete within {timeout} seconds.") from error
+			raise
+		except:
+			self.watchdog.cancel(entry)
+			raise
+		else:
+			if self.watchdog.cancel(entry):
+				log.info(f"Deadline expired as the request completed, replacing the cancelled connection to {self.address}.")
+				self.check_process()
+	
 	def logout(self):
 		"Inform the server that the session ended. The server will close the connection at its side."
+		if self.side is not None:
+			self.side.logout()
 		self._COMMAND('EXIT')
 	
 	def close(self):
 		"Close network connection to the server."
+		if self.side is not None:
+			self.side.close()
+			self.side = None
 		self.__swrapper.close()
 		del self.__swrapper
 		del self.lock
+		del self.__pending, self.__enqueued_length, self.__reply_follows
 	
 	def send_byte(self, b):
 		"Buffer one byte for sending. The argument must be 0 <= b < 256."
@@ -257,9 +873,105 @@ class Session:
 		self.__swrapper.send(s.encode('utf-8'))
 		self.__swrapper.send(self.terminator)
 	
+	def send_document(self, input_):
+		"""
+		Buffer a document for sending (see `document_chunks` for the accepted inputs), escaped and terminated. Big documents are written out progressively, in parts of about `upload_flush_size` bytes.
+		If reading the input fails midway, the request can not be completed: the unsent part is dropped and the connection shut down, the session reconnects on its next use.
+		"""
+		try:
+			for chunk in document_chunks(input_, self.upload_flush_size):
+				self.__swrapper.send(escape(chunk))
+				if len(self.__swrapper.out_buffer) >= self.upload_flush_size:
+					self.flush()
+		except:
+			log.warning(f"Upload to {self.address} failed, dropping the connection.")
+			self.__swrapper.out_buffer.clear()
+			self.cancelled = True
+			self.__swrapper.shutdown()
+			raise
+		self.__swrapper.send(self.terminator)
+	
 	def flush(self):
-		"Flush data from the output buffer."
-		self.__swrapper.flush()
+		"Flush data from the output buffer, then read the replies to the requests queued in pipeline mode, in order."
+		reply_follows = len(self.__swrapper.out_buffer) > self.__enqueued_length # a request that was not queued, its caller will read the reply
+		self.__swrapper.flush(bool(self.__pending) and len(self.__swrapper.out_buffer) > self.exchange_size)
+		self.__enqueued_length = 0
+		
+		self.__reply_follows = reply_follows
+		try:
+			while self.__pending:
+				reply = self.__pending.popleft()
+				try:
+					reply.read()
+				except:
+					while self.__pending:
+						self.__pending.popleft().abandon()
+					raise
+		finally:
+			self.__reply_follows = False
+	
+	def enqueue(self, exchange):
+		"Register a request that has been written to the output buffer. Its reply will be read on the next flush."
+		reply = Reply(self, exchange)
+		self.__pending.append(reply)
+		self.__enqueued_length = len(self.__swrapper.out_buffer)
+		if self.pipeline_owner == get_ident():
+			self.__pipelined.append(reply)
+		return reply
+	
+	@contextmanager
+	def pipeline(self):
+		"""
+		Pipeline mode. Requests of the methods decorated with `pipelined` (BIND, CONTEXT, EXECUTE, CLOSE) are queued
+		instead of being sent one by one; they return `Reply` objects. The queue is sent in one write when the block ends
+		or when any other request is made, and the replies are read back in order. The session lock is held for the whole block.
+		
+		If any of the queued requests failed, the error of the first one is raised at the end of the block.
+		Errors of the other requests are available from their `Reply` objects.
+		
+		With statistics on, the whole block is recorded as `pipeline`: the queued requests themselves transfer nothing.
+		
+		```
+			with session.pipeline():
+				query.bind('$a', 1)
+				query.bind('$b', 2)
+				result = query.execute()
+			print(result.result())
+		```
+		"""
+		
+		if self.pipeline_owner == get_ident():
+			yield self # nested pipeline joins the outer one
+			return
+		
+		self.check_process()
+		if self.stream_owner == get_ident():
+			raise BaseXProtocolError("Pipeline on a session with an open result stream.")
+		statistics = self.statistics
+		if statistics is not None:
+			start = perf_counter()
+		with self.lock:
+			if statistics is not None:
+				acquired = perf_counter()
+				sent, received = self.transferred()
+			self.pipeline_owner = get_ident()
+			self.__pipelined = []
+			try:
+				yield self
+			finally:
+				try:
+					self.flush()
+				finally:
+					self.pipeline_owner = None
+					replies = self.__pipelined
+					del self.__pipelined
+					if statistics is not None:
+						sent_after, received_after = self.transferred()
+						statistics.record('pipeline', acquired - start, perf_counter() - acquired, sent_after - sent, received_after - received, any(_reply.error is not None for _reply in replies))
+		
+		for reply in replies:
+			if reply.error is not None:
+				raise reply.error
 	
 	def recv_byte(self):
 		"Receive one byte."
@@ -272,8 +984,129 @@ class Session:
 		assert len(zero) == 1 and zero[0] == 0
 		return result.decode('utf-8')
 	
+	def recv_result(self):
+		"Receive a result string. If it is longer than `memory_limit` bytes, it is spilled to a temporary file and returned as a `Spool`."
+		if self.memory_limit is None:
+			return self.recv_str()
+		
+		chunks = []
+		length = 0
+		spool = None
+		for chunk in self.__swrapper.recv_chunks_until(self.terminator):
+			if spool is None and length + len(chunk) > self.memory_limit:
+				log.info(f"Result exceeds memory limit ({self.memory_limit} bytes), spilling to a temporary file.")
+				spool = Spool()
+				for held in chunks:
+					spool.write(held)
+				del chunks
+			if spool is None:
+				chunks.append(chunk)
+				length += len(chunk)
+			else:
+				spool.write(chunk)
+		zero = self.__swrapper.recv(1)
+		assert len(zero) == 1 and zero[0] == 0
+		
+		if spool is None:
+			return b''.join(chunks).decode('utf-8')
+		spool.seal()
+		return spool
+	
+	def recv_str_parts(self):
+		"Receive a string as the list of undecoded parts it arrived in."
+		parts = list(self.__swrapper.recv_chunks_until(self.terminator))
+		zero = self.__swrapper.recv(1)
+		assert len(zero) == 1 and zero[0] == 0
+		return parts
+	
+	def recv_str_chunks(self):
+		"Receive a string in parts, yield them decoded as they arrive. A character split between parts is decoded once complete."
+		decoder = utf8_decoder()
+		for chunk in self.__swrapper.recv_chunks_until(self.terminator):
+			text = decoder.decode(chunk)
+			if text:
+				yield text
+		text = decoder.decode(bytes(), True)
+		if text:
+			yield text
+		zero = self.__swrapper.recv(1)
+		assert len(zero) == 1 and zero[0] == 0
+	
+	def is_alive(self):
+		"Cheap local check that the connection is open and idle. Does not talk to the server."
+		try:
+			swrapper = self.__swrapper
+		except AttributeError:
+			return False
+		return not self.cancelled and not self.__pending and swrapper.is_alive()
+	
+	def tls_resumed(self):
+		"True if the current connection resumed an earlier TLS session, skipping the full handshake. Sessions are resumed across the connections to one address made with one TLS context."
+		return self.__swrapper.tls_resumed()
+	
+	def busy(self):
+		"True if the current thread is streaming results from this session, so any other request from it would have to wait for itself."
+		return self.stream_owner == get_ident()
+	
+	def open_side(self):
+		"Open and log in the secondary connection used for nested requests. Subclasses extend this to prepare it like the main one."
+		side = Session(self.user, self.password, self.address, self.family, self.tls_context, self.memory_limit)
+		side.statistics = self.statistics # nested requests count as the requests of this session
+		side.result_cache = self.result_cache
+		side.open()
+		try:
+			side.login()
+		except:
+			side.close()
+			raise
+		return side
+	
+	def available(self):
+		"Return the session to make a request on from the current thread: this one, or the side connection if this one is busy (opened on first use)."
+		self.check_process()
+		if not self.busy():
+			return self
+		if self.side is None:
+			log.info(f"Nested request while streaming results, opening side connection to {self.address}.")
+			self.side = self.open_side()
+			self.side.open_side = self.open_side # deeper nesting opens further connections the same way
+		return self.side.available()
+	
+	@contextmanager
+	def borrow(self):
+		"Context manager for `available`, a hook for subclasses that draw sessions from elsewhere."
+		yield self.available()
+	
+	def queued(self):
+		"Return the number of bytes of requests written to the output buffer and not sent yet."
+		return len(self.__swrapper.out_buffer)
+	
+	def transferred(self):
+		"Return the total numbers of bytes (sent, received) over the current connection."
+		try:
+			return self.__swrapper.sent, self.__swrapper.received
+		except AttributeError:
+			return 0, 0
+	
+	def stats(self, reset=False):
+		"Snapshot of the protocol statistics (see `Statistics.snapshot`), or None if the session does not collect them. Optionally start over."
+		if self.statistics is None:
+			return None
+		return self.statistics.snapshot(reset)
+	
+	def changed(self):
+		"Note that the contents of the database may have changed: drop the cached query results, if any."
+		if self.result_cache is not None:
+			self.result_cache.invalidate()
+	
+	def ping(self):
+		"Make a minimal round trip to the server."
+		self._COMMAND('XQUERY ()')
+	
 	def are_buffers_empty(self):
-		"Check if input and output buffers are empty."
+		"Check if input and output buffers are empty. While pipelined replies are being read, the input buffer legitimately holds the data of the following ones."
+		if self.__pending or self.__reply_follows:
+			return True
 		return self.__swrapper.are_buffers_empty()
 	
 	def __enter__(self):
@@ -300,7 +1133,7 @@ class Session:
 		self.send_str(command)
 		self.flush()
 		
-		result = self.recv_str()
+		result = self.recv_result()
 		info = self.recv_str()
 		status = self.recv_byte()		
 		if not self.are_buffers_empty():
@@ -313,6 +1146,37 @@ class Session:
 		else:
 			raise BaseXProtocolError(f"Expected status byte 0 or 1, got {hex(status)} instead.")
 	
+	@locked
+	def _COMMAND_STREAM(self, command):
+		"Executes a database command, yields the result in parts as it arrives. Errors are raised after the result has been read."
+		
+		log.info(f"BaseX command (streaming): {command}")
+		self.send_str(command)
+		self.flush()
+		
+		chunks = self.recv_str_chunks()
+		try:
+			for chunk in chunks:
+				yield chunk
+		except GeneratorExit:
+			for chunk in chunks: # the caller stopped early, read out the rest to keep the protocol stream in sync
+				pass
+			self.recv_str()
+			self.recv_byte()
+			raise
+		
+		info = self.recv_str()
+		status = self.recv_byte()
+		if not self.are_buffers_empty():
+			raise BaseXProtocolError("Garbage left in protocol buffers (_COMMAND_STREAM).")
+		
+		if status == 0x0:
+			return
+		elif status == 0x1:
+			raise BaseXCommandError(info, "COMMAND", command)
+		else:
+			raise BaseXProtocolError(f"Expected status byte 0 or 1, got {hex(status)} instead.")
+	
 	@locked
 	def _QUERY(self, query):
 		"Creates a new query instance and returns its id."
@@ -337,12 +1201,12 @@ class Session:
 	
 	@locked
 	def _CREATE(self, name, input_=''):
-		"Creates a new database with the specified input (may be empty)."
+		"Creates a new database with the specified input (may be empty). The input is a string, bytes, a path, a file object or an iterable of parts, sent progressively."
 		
-		log.info(f"BaseX create database: {name}, input length: {len(input_)}")
+		log.info(f"BaseX create database: {name}, input: {type(input_).__name__}")
 		self.send_byte(0x8)
 		self.send_str(name)
-		self.send_str(input_)
+		self.send_document(input_)
 		self.flush()
 		
 		info = self.recv_str()
@@ -359,13 +1223,13 @@ class Session:
 	
 	@locked
 	def _ADD(self, name, path, input_):
-		"Adds a new document to the opened database."
+		"Adds a new document to the opened database. The input is a string, bytes, a path, a file object or an iterable of parts, sent progressively."
 		
-		log.info(f"BaseX add XML file: database: {name}, path: {path}, input length: {len(input_)}")
+		log.info(f"BaseX add XML file: database: {name}, path: {path}, input: {type(input_).__name__}")
 		self.send_byte(0x9)
 		self.send_str(name)
 		self.send_str(path)
-		self.send_str(input_)
+		self.send_document(input_)
 		self.flush()
 		
 		info = self.recv_str()
@@ -382,12 +1246,12 @@ class Session:
 	
 	@locked
 	def _PUT(self, path, input_):
-		"Puts (adds or replaces) an XML document resource in the opened database."
+		"Puts (adds or replaces) an XML document resource in the opened database. The input is a string, bytes, a path, a file object or an iterable of parts, sent progressively."
 		
-		log.info(f"BaseX put XML file: {path}, input length: {len(input_)}")
+		log.info(f"BaseX put XML file: {path}, input: {type(input_).__name__}")
 		self.send_byte(0xc)
 		self.send_str(path)
-		self.send_str(input_)
+		self.send_document(input_)
 		self.flush()
 		
 		info = self.recv_str()
@@ -404,13 +1268,12 @@ class Session:
 	
 	@locked
 	def _PUTBINARY(self, path, input_):
-		"Puts (adds or replaces) a binary resource in the opened database. "
+		"Puts (adds or replaces) a binary resource in the opened database. The input is bytes, a path, a binary file object, an `mmap` or an iterable of parts, sent progressively."
 		
-		log.info(f"BaseX put binary file: {path}, input length: {len(input_)}")
-		self.send_byte(0x9)
+		log.info(f"BaseX put binary file: {path}, input: {type(input_).__name__}")
+		self.send_byte(0xd)
 		self.send_str(path)
-		self.send(input_) # TODO: escape
-		self.send(bytes([0]))
+		self.send_document(input_)
 		self.flush()
 		
 		info = self.recv_str()
@@ -426,13 +1289,47 @@ class Session:
 			raise BaseXProtocolError(f"Expected status byte 0 or 1, got {hex(status)} instead.")
 	
 	@locked
+	def _RETRIEVE(self, path, write):
+		"Retrieves a binary resource of the opened database, calling `write` with the unescaped data part by part as it arrives. Returns the length. A part may be a view valid only during the call."
+		
+		log.info(f"BaseX retrieve binary file: {path}")
+		self.send_str(f'RETRIEVE {path}')
+		self.flush()
+		
+		length = 0
+		write_error = None
+		for part in self.__swrapper.recv_raw_chunks():
+			if write_error is None:
+				try:
+					write(part)
+				except Exception as error:
+					write_error = error # keep reading, to leave the protocol stream in sync
+			length += len(part)
+		
+		info = self.recv_str()
+		status = self.recv_byte()
+		if not self.are_buffers_empty():
+			raise BaseXProtocolError("Garbage left in protocol buffers (_RETRIEVE).")
+		
+		if write_error is not None:
+			raise write_error
+		
+		if status == 0x0:
+			return length
+		elif status == 0x1:
+			raise BaseXCommandError(info, "RETRIEVE", path)
+		else:
+			raise BaseXProtocolError(f"Expected status byte 0 or 1, got {hex(status)} instead.")
+	
+	@locked
+	@pipelined
 	def _CLOSE(self, id_):
 		"Closes and unregisters the query with the specified id."
 		
 		log.info(f"BaseX close xquery {id_}")
 		self.send_byte(0x2)
 		self.send_str(str(id_))
-		self.flush()
+		yield
 		
 		info = self.recv_str()
 		status = self.recv_byte()
@@ -447,6 +1344,7 @@ class Session:
 			raise BaseXProtocolError(f"Expected status byte 0 or 1, got {hex(status)} ('{chr(status)}') instead.")
 	
 	@locked
+	@pipelined
 	def _BIND(self, id_, name, value, type_):
 		"Binds a value to a variable. The type will be ignored if the string is empty."
 		
@@ -456,7 +1354,7 @@ class Session:
 		self.send_str(name)
 		self.send_str(value)
 		self.send_str(type_)
-		self.flush()
+		yield
 		
 		zero = self.recv_byte()
 		if zero != 0x0:
@@ -474,17 +1372,42 @@ class Session:
 			raise BaseXProtocolError(f"Expected status byte 0 or 1, got {hex(status)} instead.")
 	
 	@locked
-	def _RESULTS(self, id_):
-		"Returns all resulting items as strings, prefixed by a single byte that represents the Type ID."
+	def _RESULTS(self, id_, raw=False):
+		"Returns all resulting items as strings (or undecoded `Item`s if `raw`), prefixed by a single byte that represents the Type ID."
 		
 		log.info(f"BaseX iterate through xquery results {id_}")
 		self.send_byte(0x4)
 		self.send_str(str(id_))
 		self.flush()
 		
+		reply = self.__results_reply(id_, raw)
+		try:
+			for item in reply:
+				yield item
+		except GeneratorExit:
+			for item in reply: # the caller stopped early, read out the rest to keep the protocol stream in sync
+				pass
+			raise
+	
+	@locked
+	@pipelined
+	def _RESULTS_ALL(self, id_, raw=False):
+		"Same request as `_RESULTS`, but the items are read into a list, so the request can be pipelined."
+		
+		log.info(f"BaseX fetch all xquery results {id_}")
+		self.send_byte(0x4)
+		self.send_str(str(id_))
+		yield
+		
+		return list(self.__results_reply(id_, raw))
+	
+	def __results_reply(self, id_, raw):
 		typeid = self.recv_byte()
 		while typeid != 0x0:
-			item = self.recv_str()
+			if raw:
+				item = Item(self.recv_str_parts())
+			else:
+				item = self.recv_result()
 			yield typeid, item
 			typeid = self.recv_byte()
 		
@@ -503,15 +1426,16 @@ class Session:
 			raise BaseXProtocolError(f"Expected status byte 0 or 1, got {hex(status)} instead.")
 	
 	@locked
+	@pipelined
 	def _EXECUTE(self, id_):
 		"Executes the query and returns the result as a single string."
 		
 		log.info(f"BaseX execute xquery {id_}")
 		self.send_byte(0x5)
 		self.send_str(str(id_))
-		self.flush()
+		yield
 		
-		result = self.recv_str()
+		result = self.recv_result()
 		status = self.recv_byte()
 		
 		if status == 0x0:
@@ -526,10 +1450,44 @@ class Session:
 		else:
 			raise BaseXProtocolError(f"Expected status byte 0 or 1, got {hex(status)} instead.")
 	
+	@locked
+	def _EXECUTE_STREAM(self, id_):
+		"Executes the query and yields the result in parts (decoded strings) as it arrives. Errors are raised at the end."
+		
+		log.info(f"BaseX execute xquery (streaming) {id_}")
+		self.send_byte(0x5)
+		self.send_str(str(id_))
+		self.flush()
+		
+		chunks = self.recv_str_chunks()
+		try:
+			for chunk in chunks:
+				yield chunk
+		except GeneratorExit:
+			for chunk in chunks: # the caller stopped early, read out the rest to keep the protocol stream in sync
+				pass
+			if self.recv_byte() == 0x1:
+				self.recv_str()
+			raise
+		
+		status = self.recv_byte()
+		
+		if status == 0x0:
+			if not self.are_buffers_empty():
+				raise BaseXProtocolError("Garbage left in protocol buffers (_EXECUTE_STREAM, no error).")
+			return
+		elif status == 0x1:
+			info = self.recv_str()
+			if not self.are_buffers_empty():
+				raise BaseXProtocolError("Garbage left in protocol buffers (_EXECUTE_STREAM, error).")
+			raise BaseXQueryError(info, "EXECUTE", id_)
+		else:
+			raise BaseXProtocolError(f"Expected status byte 0 or 1, got {hex(status)} instead.")
+	
 	@locked
 	def _INFO(self, id_):
 		"Returns a string with query compilation and profiling info."
-
+		
 		self.send_byte(0x6)
 		self.send_str(str(id_))
 		self.flush()
@@ -573,14 +1531,15 @@ class Session:
 			raise BaseXProtocolError(f"Expected status byte 0 or 1, got {hex(status)} instead.")
 	
 	@locked
+	@pipelined
 	def _CONTEXT(self, id_, value, type_):
 		"Binds a value to the context. The type will be ignored if the string is empty."
-
-		self.send_bytes(0xe)
+		
+		self.send_byte(0xe)
 		self.send_str(str(id_))
 		self.send_str(value)
 		self.send_str(type_)
-		self.flush()
+		yield
 		
 		zero = self.recv_byte()
 		if zero != 0x0:
@@ -655,19 +1614,653 @@ class Session:
 		else:
 			raise BaseXProtocolError(f"Expected status byte 0 or 1, got {hex(status)} instead.")
 	
-	create = _CREATE
-	add = _ADD
-	put = _PUT
-	put_binary = _PUTBINARY
+	def create(self, name, input_=''):
+		try:
+			return self.available()._CREATE(name, input_)
+		finally:
+			self.changed()
+	
+	def add(self, name, path, input_):
+		try:
+			return self.available()._ADD(name, path, input_)
+		finally:
+			self.changed()
+	
+	def put(self, path, input_):
+		try:
+			return self.available()._PUT(path, input_)
+		finally:
+			self.changed()
+	
+	def put_binary(self, path, input_):
+		try:
+			return self.available()._PUTBINARY(path, input_)
+		finally:
+			self.changed()
+	
+	def retrieve(self, path, sink=None):
+		"Download a binary resource of the opened database. Return it as bytes, or write it part by part to `sink` (an object with `write`, like a file, or `sendall`, like a socket) and return the length."
+		if sink is None:
+			sink = io.BytesIO()
+			self.available()._RETRIEVE(path, sink.write)
+			return sink.getvalue()
+		elif hasattr(sink, 'write'):
+			return self.available()._RETRIEVE(path, sink.write)
+		else:
+			return self.available()._RETRIEVE(path, sink.sendall)
+	
+	def retrieve_into(self, path, buffer):
+		"Download a binary resource of the opened database straight into a preallocated writable buffer, like a `bytearray`. Return the length. Raises `ValueError` if it does not fit."
+		target = memoryview(buffer).cast('B')
+		position = 0
+		
+		def write(part):
+			nonlocal position
+			if position + len(part) > len(target):
+				raise ValueError(f"Binary resource does not fit in the buffer of {len(target)} bytes: {path}")
+			target[position:position + len(part)] = part
+			position += len(part)
+		
+		with target:
+			return self.available()._RETRIEVE(path, write)
+	
+	create.__doc__ = _CREATE.__doc__
+	add.__doc__ = _ADD.__doc__
+	put.__doc__ = _PUT.__doc__
+	put_binary.__doc__ = _PUTBINARY.__doc__
 	
 	def query(self, query):
-		"Return an XQuery helper."
-		return Query(self, query)
+		"Return an XQuery helper. Queries created while this thread streams results from the session run on the side connection."
+		return Query(self.available(), query)
+	
+	def execute_many(self, query, param_sets, batch_size=256, batch_bytes=1 << 20):
+		"Run one query (string or `Query`) against many sets of bindings, yield results as strings in input order. See `Query.execute_many`."
+		if not isinstance(query, Query):
+			query = self.query(query)
+		return query.execute_many(param_sets, batch_size, batch_bytes)
+	
+	def results_many(self, query, param_sets, batch_size=256, batch_bytes=1 << 20):
+		"Run one query (string or `Query`) against many sets of bindings, yield lists of results in input order. See `Query.results_many`."
+		if not isinstance(query, Query):
+			query = self.query(query)
+		return query.results_many(param_sets, batch_size, batch_bytes)
 	
 	@property
 	def execute(self):
 		"Return command helper."
-		return Command(self)
+		return Command(self.available())
+
+
+class SessionPool:
+	"""
+	Pool of logged-in sessions to one server. Sessions are opened on demand, up to `maxsize`, and reused afterwards.
+	
+	An idle session is checked before it is handed out again: a closed or dirty connection is thrown away,
+	and one that has been idle for more than `check_idle` seconds must also answer a ping. A session whose
+	operation failed with a protocol or network error is thrown away instead of being returned to the pool.
+	
+	The pool belongs to the process that created it. In a forked child the inherited sessions are dropped
+	(without logging out, as the connections still serve the parent) and new ones are opened.
+	
+	`warm_up` opens sessions in advance, to have them ready at startup.
+	
+	`setup` is called with every new session after login. `memory_limit` and `result_cache` are passed to the sessions, all of them share the one cache.
+	
+	```
+		pool = SessionPool('user', 'password', ('::1', 1984), maxsize=8)
+		with pool.borrow() as session:
+			print(session.execute.info())
+		pool.close()
+	```
+	"""
+	
+	def __init__(self, user, password, address, family=socket.AF_INET6, tls_context=None, maxsize=8, setup=None, check_idle=30, session_class=Session, memory_limit=None, result_cache=None):
+		self.user = user
+		self.password = password
+		self.address = address
+		self.family = family
+		self.tls_context = tls_context
+		self.memory_limit = memory_limit
+		self.result_cache = result_cache
+		self.maxsize = maxsize
+		self.setup = setup
+		self.check_idle = check_idle
+		self.session_class = session_class
+		self.closed = False
+		self.__reset()
+	
+	def __reset(self):
+		self.pid = os.getpid()
+		self.idle = deque() # (session, time returned), most recently used last
+		self.size = 0 # idle and borrowed sessions
+		self.condition = Condition()
+	
+	def __check_process(self):
+		if self.pid != os.getpid():
+			for session, since in self.idle:
+				try:
+					session.close()
+				except OSError:
+					pass
+			self.__reset()
+	
+	def connect(self):
+		"Open and log in a new session."
+		session = self.session_class(self.user, self.password, self.address, self.family, self.tls_context, self.memory_limit)
+		session.result_cache = self.result_cache
+		session.open()
+		try:
+			session.login()
+			if self.setup is not None:
+				self.setup(session)
+		except:
+			session.close()
+			raise
+		return session
+	
+	def warm_up(self, n=None):
+		"""
+		Open and log in sessions ahead of use, until `n` of them (by default `maxsize`) are idle or the pool is full. Return the number opened.
+		The first one is opened alone, so that the others can resume its TLS session; the rest in parallel.
+		If the first one fails, the error is raised; failures of the others are logged.
+		"""
+		if self.closed:
+			raise ValueError("Session pool closed.")
+		self.__check_process()
+		
+		with self.condition:
+			count = max(0, min((self.maxsize if n is None else n) - len(self.idle), self.maxsize - self.size))
+			self.size += count
+		
+		opened = []
+		errors = []
+		
+		def connect():
+			try:
+				opened.append(self.connect())
+			except (BaseXError, OSError) as error:
+				self.__forget()
+				errors.append(error)
+		
+		if count:
+			connect()
+			if errors: # no use trying the others
+				for _n in range(count - 1):
+					self.__forget()
+			else:
+				threads = [Thread(target=connect, name=f'warm-up-{_n}', daemon=True) for _n in range(count - 1)]
+				for thread in threads:
+					thread.start()
+				for thread in threads:
+					thread.join()
+		
+		with self.condition:
+			now = monotonic()
+			self.idle.extend((_session, now) for _session in opened)
+			self.condition.notify_all()
+		
+		if errors:
+			if not opened:
+				raise errors[0]
+			log.warning(f"Opened {len(opened)} of {count} sessions to {self.address}: {errors[0]}")
+		return len(opened)
+	
+	def validate(self, session, since):
+		"Check if an idle session can be reused."
+		if not session.is_alive():
+			return False
+		if self.check_idle is not None and monotonic() - since > self.check_idle:
+			try:
+				session.ping()
+			except (BaseXError, OSError):
+				return False
+		return True
+	
+	def acquire(self, timeout=None):
+		"Take a session from the pool. Open a new one if none is idle and the pool is not full, otherwise wait up to `timeout` seconds."
+		if self.closed:
+			raise ValueError("Session pool closed.")
+		self.__check_process()
+		
+		deadline = monotonic() + timeout if timeout is not None else None
+		while True:
+			with self.condition:
+				while not self.idle and self.size >= self.maxsize:
+					remaining = deadline - monotonic() if deadline is not None else None
+					if remaining is not None and remaining <= 0:
+						raise TimeoutError("No session available in the pool.")
+					self.condition.wait(remaining)
+				
+				if self.idle:
+					session, since = self.idle.pop()
+				else:
+					session = None
+					self.size += 1
+			
+			if session is None:
+				try:
+					return self.connect()
+				except:
+					self.__forget()
+					raise
+			elif self.validate(session, since):
+				return session
+			else:
+				log.info("Discarding broken pooled session.")
+				self.discard(session)
+	
+	def release(self, session):
+		"Return a borrowed session to the pool."
+		if self.closed or self.pid != os.getpid():
+			self.discard(session)
+			return
+		with self.condition:
+			self.idle.append((session, monotonic()))
+			self.condition.notify()
+	
+	def discard(self, session):
+		"Close a borrowed session instead of returning it to the pool."
+		try:
+			session.close()
+		except (AttributeError, OSError):
+			pass
+		self.__forget()
+	
+	def __forget(self):
+		with self.condition:
+			self.size -= 1
+			self.condition.notify()
+	
+	@contextmanager
+	def borrow(self, timeout=None):
+		"Context manager for `acquire` and `release`. The session is discarded if the block fails with a protocol or network error."
+		session = self.acquire(timeout)
+		try:
+			yield session
+		except (BaseXProtocolError, OSError):
+			self.discard(session)
+			raise
+		except:
+			self.release(session)
+			raise
+		else:
+			self.release(session)
+	
+	def close(self):
+		"Log out and close the idle sessions. Sessions borrowed at the moment are closed when returned."
+		self.closed = True
+		self.__check_process()
+		with self.condition:
+			idle = list(self.idle)
+			self.idle.clear()
+		for session, since in idle:
+			try:
+				session.logout()
+			except (BaseXError, OSError):
+				pass
+			self.discard(session)
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *args):
+		self.close()
+
+
+class Statistics:
+	"""
+	Protocol statistics of a session. For every protocol method: number of calls and failures, time spent waiting
+	for the session lock, time spent in the call, bytes sent and received, and a histogram of the call durations
+	in fixed buckets (upper bounds in seconds in `bounds`, the last bucket is unbounded).
+	A session shares its statistics with its side connections, so they are updated under a lock.
+	
+	```
+		session = Session('user', 'password', ('::1', 1984), statistics=True)
+		...
+		for method, entry in session.stats(reset=True).items():
+			print(method, entry['calls'], entry['time'] / entry['calls'])
+	```
+	"""
+	
+	bounds = 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+	
+	def __init__(self):
+		self.methods = {}
+		self.lock = RLock()
+	
+	def record(self, name, wait, duration, sent, received, failed):
+		bucket = bisect_right(self.bounds, duration)
+		with self.lock:
+			try:
+				entry = self.methods[name]
+			except KeyError:
+				entry = self.methods[name] = [0, 0, 0.0, 0.0, 0, 0, [0] * (len(self.bounds) + 1)]
+			entry[0] += 1
+			entry[1] += failed
+			entry[2] += wait
+			entry[3] += duration
+			entry[4] += sent
+			entry[5] += received
+			entry[6][bucket] += 1
+	
+	def snapshot(self, reset=False):
+		"Return a dict: method name -> dict of `calls`, `failures`, `lock_wait`, `time`, `sent`, `received`, `histogram` (list of counts per bucket). Optionally start over."
+		with self.lock:
+			if reset:
+				methods, self.methods = self.methods, {}
+			else:
+				methods = self.methods
+			
+			return {
+				_name: {'calls': _calls, 'failures': _failures, 'lock_wait': _wait, 'time': _duration, 'sent': _sent, 'received': _received, 'histogram': list(_histogram)}
+				for (_name, (_calls, _failures, _wait, _duration, _sent, _received, _histogram)) in list(methods.items())
+			}
+
+
+class ResultCache:
+	"""
+	Results of read-only queries, by query string, request, bound variables and context value. Give it to the sessions
+	that work on one database (`Session`, `SessionPool`), and identical requests are answered without the server.
+	
+	Every query is classified once with `Query.updating`. Results of updating queries are never stored. Executing one of them
+	through a session with the cache drops all the results, as do uploads and the database commands in `updating_commands`
+	(others, like CHECK, OPEN, SET or INFO, leave the data as it is).
+	While a cache is in use, bindings are only sent to the server together with a request that is not answered from the cache,
+	so errors in them are raised from that request.
+	
+	At most `capacity` results are kept, the least recently used one is dropped first. Results older than `ttl` seconds are not used.
+	Changes made by other clients of the server are not noticed: `ttl` bounds how stale a result can be.
+	
+	```
+		cache = ResultCache(capacity=1024, ttl=10)
+		session = Session('user', 'password', ('::1', 1984), result_cache=cache)
+		...
+		print(cache.stats()['hit_rate'])
+	```
+	"""
+	
+	updating_commands = frozenset({'CREATE', 'DROP', 'ALTER', 'COPY', 'RESTORE', 'OPTIMIZE', 'ADD', 'DELETE', 'RENAME', 'REPLACE', 'PUT', 'STORE', 'XQUERY', 'RUN', 'EXECUTE'})
+	
+	def __init__(self, capacity=256, ttl=None):
+		self.capacity = capacity
+		self.ttl = ttl
+		self.results = OrderedDict()
+		self.lock = RLock()
+		self.generation = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
+		self.invalidations = 0
+	
+	def lookup(self, key):
+		"Return (True, result) if a fresh result is stored under the key, (False, None) otherwise."
+		with self.lock:
+			try:
+				stored, result = self.results[key]
+			except KeyError:
+				self.misses += 1
+				return False, None
+			
+			if self.ttl is not None and monotonic() - stored > self.ttl:
+				del self.results[key]
+				self.expirations += 1
+				self.misses += 1
+				return False, None
+			
+			self.results.move_to_end(key)
+			self.hits += 1
+			return True, result
+	
+	def store(self, key, result, generation):
+		"Store a result requested while `generation` was current. If the cache has been invalidated since, the result may be stale and it is dropped."
+		with self.lock:
+			if generation != self.generation:
+				return
+			self.results[key] = monotonic(), result
+			self.results.move_to_end(key)
+			while len(self.results) > self.capacity:
+				self.results.popitem(last=False)
+				self.evictions += 1
+	
+	def invalidate(self):
+		"Drop all the results."
+		with self.lock:
+			self.generation += 1
+			self.invalidations += 1
+			self.results.clear()
+	
+	def stats(self, reset=False):
+		"Return a dict of `size`, `hits`, `misses`, `hit_rate` (None before the first lookup), `evictions`, `expirations` and `invalidations`. Optionally start the counters over."
+		with self.lock:
+			lookups = self.hits + self.misses
+			stats = {
+				'size': len(self.results),
+				'hits': self.hits,
+				'misses': self.misses,
+				'hit_rate': self.hits / lookups if lookups else None,
+				'evictions': self.evictions,
+				'expirations': self.expirations,
+				'invalidations': self.invalidations
+			}
+			if reset:
+				self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+			return stats
+
+
+class Reply:
+	"""
+	Reply to a request queued in pipeline mode. The value is available after the session has been flushed,
+	which happens at the latest at the end of the `Session.pipeline` block.
+	"""
+	
+	def __init__(self, session, exchange):
+		self.session = session
+		self.exchange = exchange
+		self.done = False
+		self.value = None
+		self.error = None
+		self.callbacks = []
+	
+	@classmethod
+	def ready(cls, value):
+		"Reply that is complete from the start, for a request answered without the server (like a cached result)."
+		reply = cls(None, None)
+		reply.value = value
+		reply.done = True
+		return reply
+	
+	def then(self, callback):
+		"Call `callback(reply)` when the reply is complete, successful or not. At once if it already is."
+		if self.done:
+			callback(self)
+		else:
+			self.callbacks.append(callback)
+	
+	def __complete(self):
+		self.done = True
+		for callback in self.callbacks:
+			callback(self)
+		self.callbacks.clear()
+	
+	def read(self):
+		"Read the reply from the session input. Called by `Session.flush` in the order the requests were queued."
+		try:
+			next(self.exchange)
+		except StopIteration as stop:
+			self.value = stop.value
+		except (BaseXQueryError, BaseXCommandError) as error:
+			self.error = error
+		else:
+			raise BaseXProtocolError("Pipelined method yielded more than once.")
+		finally:
+			self.__complete()
+	
+	def abandon(self):
+		"Mark the reply as lost, after an earlier reply broke the protocol stream."
+		self.exchange.close()
+		self.error = BaseXProtocolError("Reply lost due to an earlier protocol error.")
+		self.__complete()
+	
+	def result(self):
+		"Return the value of the reply, or raise the error it carried. Flushes the session if the reply has not been read yet."
+		if not self.done:
+			self.session.flush()
+		if self.error is not None:
+			raise self.error
+		return self.value
+
+
+class Spool:
+	"""
+	Result too big to be held in memory, returned instead of a string by sessions with `memory_limit` set.
+	The UTF-8 data is kept in an unlinked temporary file, memory-mapped for reading.
+	
+	```
+		result = query.execute()
+		if isinstance(result, Spool):
+			with result:
+				for chunk in result: # decoded text, in parts
+					output.write(chunk)
+	```
+	
+	`open()` returns a text file object reading the data, `data` is a memoryview of the raw bytes and `str(spool)` decodes it all.
+	"""
+	
+	class Reader(io.RawIOBase):
+		"Raw binary stream over the mapped data, with its own position."
+		
+		def __init__(self, map_):
+			self.map = map_
+			self.position = 0
+		
+		def readable(self):
+			return True
+		
+		def seekable(self):
+			return True
+		
+		def readinto(self, b):
+			n = max(0, min(len(b), len(self.map) - self.position))
+			b[:n] = self.map[self.position:self.position + n]
+			self.position += n
+			return n
+		
+		def seek(self, offset, whence=io.SEEK_SET):
+			if whence == io.SEEK_SET:
+				self.position = offset
+			elif whence == io.SEEK_CUR:
+				self.position += offset
+			elif whence == io.SEEK_END:
+				self.position = len(self.map) + offset
+			else:
+				raise ValueError(f"Invalid whence: {whence}")
+			return self.position
+		
+		def tell(self):
+			return self.position
+	
+	chunk_size = 1 << 16
+	
+	def __init__(self):
+		self.file = TemporaryFile()
+		self.map = None
+		self.length = 0
+	
+	def write(self, b):
+		self.file.write(b)
+		self.length += len(b)
+	
+	def seal(self):
+		"Finish writing and map the file for reading."
+		self.file.flush()
+		self.map = mmap(self.file.fileno(), 0, access=ACCESS_READ)
+	
+	def __len__(self):
+		"Length of the data in bytes."
+		return self.length
+	
+	@property
+	def data(self):
+		return memoryview(self.map)
+	
+	def __str__(self):
+		return str(self.map[:], 'utf-8')
+	
+	def __iter__(self):
+		"Yield the decoded text in parts of about `chunk_size` bytes."
+		decoder = utf8_decoder()
+		for start in range(0, self.length, self.chunk_size):
+			text = decoder.decode(self.map[start:start + self.chunk_size])
+			if text:
+				yield text
+		text = decoder.decode(bytes(), True)
+		if text:
+			yield text
+	
+	def open(self):
+		"Return a text file object reading the data from the beginning. Independent of other readers."
+		return io.TextIOWrapper(io.BufferedReader(self.Reader(self.map)), encoding='utf-8')
+	
+	def close(self):
+		"Unmap and remove the temporary file."
+		if self.map is not None:
+			self.map.close()
+			self.map = None
+		self.file.close()
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *args):
+		self.close()
+
+
+class Item:
+	"""
+	Result item kept as the raw UTF-8 data, decoded only when asked. Yielded by `Query.results(raw=True)`.
+	
+	The data stays in the parts it was received in: `bytes(item)` joins them, `chunks()` decodes them
+	one by one with an incremental decoder (a character split between parts is handled), `str(item)` decodes all (once).
+	Forwarding the data elsewhere, or dropping the item, costs no decoding at all.
+	"""
+	
+	__slots__ = 'parts', 'text'
+	
+	def __init__(self, parts):
+		self.parts = parts
+		self.text = None
+	
+	def __len__(self):
+		"Length of the data in bytes."
+		return sum(len(_part) for _part in self.parts)
+	
+	def __bytes__(self):
+		if len(self.parts) == 1:
+			return self.parts[0]
+		return b''.join(self.parts)
+	
+	def chunks(self):
+		"Yield the decoded text part by part."
+		if self.text is not None:
+			yield self.text
+			return
+		decoder = utf8_decoder()
+		for part in self.parts:
+			text = decoder.decode(part)
+			if text:
+				yield text
+		text = decoder.decode(bytes(), True)
+		if text:
+			yield text
+	
+	def __str__(self):
+		if self.text is None:
+			self.text = ''.join(self.chunks())
+		return self.text
+	
+	def __repr__(self):
+		return f'{self.__class__.__name__}({bytes(self)!r})'
 
 
 class Command:
@@ -691,7 +2284,16 @@ class Command:
 		self.__session = session
 	
 	def __getattr__(self, attr):
-		return lambda *args: self.__session._COMMAND(' '.join([attr.upper().replace('_', ' ').strip()] + [str(_arg) for _arg in args]))
+		name = attr.upper().replace('_', ' ').strip()
+		return lambda *args: self.__run(name, args)
+	
+	def __run(self, name, args):
+		session = self.__session
+		try:
+			return session._COMMAND(' '.join([name] + [str(_arg) for _arg in args]))
+		finally:
+			if session.result_cache is not None and name.split()[0] in session.result_cache.updating_commands:
+				session.changed()
 
 
 class Query:
@@ -710,10 +2312,22 @@ class Query:
 		result = query.execute()
 		process_all(result)
 		
+		# retrieve result as one big string, in parts as they arrive
+		for chunk in query.stream():
+			output.write(chunk)
+		
 		# iterate through results one by one
 		for typeid, item in query.results(): 
 			process_one(item)
 		
+		# iterate through undecoded results
+		for typeid, item in query.results(raw=True):
+			output.write(bytes(item))
+		
+		# iterate through results read ahead by a background thread
+		for typeid, item in query.prefetch(1000):
+			process_one(item)
+		
 		query.close() # make sure to close the query if an error happens
 	```
 	
@@ -741,6 +2355,15 @@ class Query:
 		for typeid, item in session.query("XQUERY..."): # use the object as iterator
 			process_one(item)
 	```
+	
+	Send bindings and execution in one round trip:
+	```
+		with session.pipeline():
+			query.bind('$a', 1)
+			query.bind('$b', 2)
+			result = query.execute()
+		process_all(result.result())
+	```
 	"""
 	
 	typeids = [
@@ -759,6 +2382,10 @@ class Query:
 		"Initialize the Query object with a session and query string. The session does not have to be active, but it must be activated before opening the query."
 		self.session = session
 		self.query = query
+		self.bindings = {}
+		self.context_value = None
+		self.unsent = {} # variable name (None for the context): deferred request, only the latest one per name
+		self.__updating = None
 	
 	def is_open(self):
 		return hasattr(self, 'id_')
@@ -768,6 +2395,10 @@ class Query:
 		if hasattr(self, 'id_'):
 			raise ValueError("Query already active.")
 		self.id_ = int(self.session._QUERY(self.query))
+		self.connection = self.session.connections
+		self.bindings = {}
+		self.context_value = None
+		self.unsent = {}
 		log.info(f"Opened xquery id {self.id_}")
 		return self.id_
 	
@@ -775,25 +2406,232 @@ class Query:
 		"Closes the query and frees the resources on the server. Might be open again later."
 		if not hasattr(self, 'id_'):
 			raise ValueError("Query not in active state.")
-		self.session._CLOSE(self.id_)
+		self.session.check_process()
+		if self.connection == self.session.connections:
+			self.session._CLOSE(self.id_)
 		del self.id_
 	
-	def execute(self):
-		"Return the result of the query as one big string."
-		return self.session._EXECUTE(self.id_)
+	def handle(self):
+		"""
+		Return the query id. If the session has reconnected since the query was opened (for instance in a forked child),
+		or the query was closed meanwhile by another user of the object (like a cache evicting it), prepare it again first,
+		with the values that were bound to it.
+		"""
+		self.session.check_process()
+		if not hasattr(self, 'id_'):
+			if not hasattr(self, 'connection'):
+				raise ValueError("Query not in active state.")
+			self.__reopen()
+			self.reopened()
+		elif self.connection != self.session.connections:
+			del self.id_
+			self.__reopen()
+		return self.id_
+	
+	def __reopen(self):
+		bindings, context_value = self.bindings, self.context_value
+		self.open()
+		for name, (value, type_) in bindings.items():
+			self.bind(name, value, type_)
+		if context_value is not None:
+			self.context(*context_value)
+	
+	def reopened(self):
+		"Called when `handle` has prepared the query again after another user closed it. A cache that closed it replaces this to take it back."
+		pass
+	
+	def execute(self, timeout=None):
+		"Return the result of the query as one big string. In pipeline mode return a `Reply` for it. See `Session.deadline` for `timeout`, which does not apply in pipeline mode."
+		with self.session.deadline(timeout):
+			cache = self.session.result_cache
+			if cache is None:
+				return self.session._EXECUTE(self.handle())
+			return self.__cached(cache, self.session._EXECUTE, 'execute')
+	
+	def __cached(self, cache, method, *request):
+		"Make a pipelined request through the result cache. Results spooled to disk (see `Session.recv_result`) are not stored."
+		if self.__is_updating():
+			self.__send_bindings()
+			reply = method(self.handle())
+			if isinstance(reply, Reply):
+				reply.then(lambda _reply: cache.invalidate())
+			else:
+				cache.invalidate()
+			return reply
+		
+		key = self.__cache_key(*request)
+		found, result = cache.lookup(key)
+		if found:
+			return Reply.ready(result) if self.session.pipeline_owner == get_ident() else result
+		
+		generation = cache.generation
+		self.__send_bindings()
+		reply = method(self.handle())
+		
+		def store(reply):
+			if reply.error is None and not isinstance(reply.value, Spool):
+				cache.store(key, reply.value, generation)
+		
+		if isinstance(reply, Reply):
+			reply.then(store)
+		elif not isinstance(reply, Spool):
+			cache.store(key, reply, generation)
+		return reply
+	
+	def __is_updating(self):
+		if self.__updating is None:
+			self.__updating = self.updating()
+		return self.__updating
+	
+	def __cache_key(self, *request):
+		return (self.query,) + request + (tuple(sorted(self.bindings.items())), self.context_value)
+	
+	def __send_bindings(self):
+		"Send the bindings deferred while a result cache is in use. Return their replies."
+		if not self.unsent:
+			return []
+		unsent, self.unsent = self.unsent, {}
+		with self.session.pipeline():
+			return [_method(self.handle(), *_args) for (_method, _args) in unsent.values()]
+	
+	def stream(self):
+		"Execute the query and yield the result as strings, in parts as they arrive from the server. Concatenated, they give the result of `execute`."
+		updating = self.session.result_cache is not None and self.__is_updating()
+		self.__send_bindings()
+		chunks = self.session._EXECUTE_STREAM(self.handle())
+		if updating:
+			chunks = self.__invalidating(chunks)
+		try:
+			yield from chunks
+		finally:
+			chunks.close()
+	
+	def results(self, raw=False, timeout=None):
+		"Yield results one by one as (typeid, value). With `raw`, values are `Item`s holding the undecoded data. Items over `memory_limit` come as a `Spool`. See `Session.deadline` for `timeout`."
+		if timeout is not None:
+			return self.__within(self.results(raw), timeout)
+		
+		cache = self.session.result_cache
+		if cache is None:
+			return self.__results(raw)
+		
+		if self.__is_updating():
+			self.__send_bindings()
+			return self.__invalidating(self.__results(raw))
+		
+		key = self.__cache_key('results', raw)
+		found, results = cache.lookup(key)
+		if found:
+			return (_result for _result in results)
+		return self.__storing(cache, key, cache.generation, raw)
 	
-	def results(self):
-		"Yield results one by one as (typeid, value)."
-		for typeid, value in self.session._RESULTS(self.id_):
+	def __within(self, results, timeout):
+		with self.session.deadline(timeout):
 			try:
-				typestr = self.typeids[typeid]
-			except KeyError:
-				typestr = None
-			yield typestr, value
+				yield from results
+			finally:
+				results.close()
+	
+	def __storing(self, cache, key, generation, raw):
+		"Yield the results and store them in the cache, once all have been read."
+		self.__send_bindings()
+		results = self.__results(raw)
+		stored = []
+		try:
+			for result in results:
+				stored.append(result)
+				yield result
+		finally:
+			results.close()
+		if not any(isinstance(_value, Spool) for (_typeid, _value) in stored): # the caller owns the spools
+			cache.store(key, stored, generation)
+	
+	def __invalidating(self, results):
+		"Yield the results of an updating query, then drop the cached results."
+		try:
+			yield from results
+		finally:
+			results.close()
+			self.session.result_cache.invalidate()
+	
+	def __results(self, raw):
+		results = self.session._RESULTS(self.handle(), raw)
+		try:
+			for typeid, value in results:
+				try:
+					typestr = self.typeids[typeid]
+				except IndexError:
+					typestr = None
+				yield typestr, value
+		finally:
+			results.close() # release the session before the caller goes on, even if iteration stopped early
+	
+	def prefetch(self, maxsize=0, convert=None, release=None, timeout=None):
+		"""
+		Like `results`, but a background thread reads the results into a queue of at most `maxsize` items (0 for no limit),
+		as fast as the network allows, while the caller consumes them. `convert(typestr, value)` is applied in the thread if given.
+		The session is released as soon as the last result is read; with a bounded queue the reading pauses while the queue is full.
+		After that `release()` is called from the thread, if given. Requests made from the calling thread while the results stream in
+		go to the side connection, from the first item on (the caller can only make them once it has that item anyway).
+		The thread starts right away; close the returned generator to stop it early. `timeout` limits the reading (see `Session.deadline`).
+		"""
+		items = Queue(maxsize)
+		stop = Event()
+		consumer = get_ident()
+		
+		def read():
+			reader = get_ident()
+			handed = False
+			try:
+				results = self.results(timeout=timeout)
+				try:
+					for typestr, value in results:
+						if self.session.stream_owner == reader: # draining the locked stream, not replaying cached results
+							self.session.stream_owner = consumer # requests of the consumer would wait for this thread, send them to the side connection
+							handed = True
+						if stop.is_set():
+							break
+						items.put((True, convert(typestr, value) if convert is not None else (typestr, value)))
+				finally:
+					results.close()
+					if handed and self.session.stream_owner == consumer:
+						self.session.stream_owner = None
+			except BaseException as error:
+				items.put((False, error))
+			else:
+				items.put((None, None))
+			finally:
+				if release is not None:
+					release()
+		
+		thread = Thread(target=read, name=f'prefetch-{self.query[:32]}', daemon=True)
+		thread.start()
+		return self.__prefetched(items, stop, thread)
+	
+	@staticmethod
+	def __prefetched(items, stop, thread):
+		try:
+			while True:
+				ok, value = items.get()
+				if ok is None:
+					break
+				elif ok:
+					yield value
+				else:
+					raise value
+		finally:
+			stop.set()
+			while thread.is_alive(): # make room for the reader blocked on a full queue, until it has drained the stream
+				try:
+					items.get(timeout=0.05)
+				except Empty:
+					pass
+			thread.join()
 	
 	def full(self):
 		"Yield results one by one as (typeid, XDM, value). XDM is an URL for typeids: document-node(), attribute(), xs:QName otherwise is None."
-		for typeid, xdm, value in self.session._FULL(self.id_):
+		self.__send_bindings()
+		for typeid, xdm, value in self.session._FULL(self.handle()):
 			try:
 				typestr = self.typeids[typeid]
 			except KeyError:
@@ -802,22 +2640,94 @@ class Query:
 	
 	def info(self):
 		"Return compilation and profiling info of this query."
-		return self.session._INFO(self.id_)
+		return self.session._INFO(self.handle())
 	
 	def options(self):
 		"Return query serialization parameters."
-		return self.session._OPTIONS(self.id_)
+		return self.session._OPTIONS(self.handle())
 	
 	def updating(self):
 		"Check if this query is updating (writing) resources, or is read-only."
-		return self.session._UPDATING(self.id_) == 'true'
+		return self.session._UPDATING(self.handle()) == 'true'
 	
 	def bind(self, name, value, type_=''):
-		"Bind a value to an external variable declared in the query."
-		return self.session._BIND(self.id_, name, str(value), type_)
+		"Bind a value to an external variable declared in the query. With a result cache, the binding is sent along with the next request that needs the server."
+		self.bindings[name] = str(value), type_ # bound again if the query has to be prepared again
+		if self.session.result_cache is None:
+			return self.session._BIND(self.handle(), name, str(value), type_)
+		self.handle()
+		self.unsent[name] = self.session._BIND, (name, str(value), type_)
+		return Reply.ready(None) if self.session.pipeline_owner == get_ident() else None
 	
 	def context(self, value, type_=''):
-		return self.session._CONTEXT(self.id_, value, type_)
+		self.context_value = value, type_
+		if self.session.result_cache is None:
+			return self.session._CONTEXT(self.handle(), value, type_)
+		self.handle()
+		self.unsent[None] = self.session._CONTEXT, (value, type_)
+		return Reply.ready(None) if self.session.pipeline_owner == get_ident() else None
+	
+	def execute_many(self, param_sets, batch_size=256, batch_bytes=1 << 20):
+		"""
+		Execute the query once for every set of bindings, yield the results as strings in input order.
+		A parameter set is a mapping of variable names to values, or to (value, type) pairs.
+		Binds and executions are pipelined through the one query handle, `batch_size` parameter sets per round trip,
+		fewer if their requests take more than `batch_bytes`.
+		The query is opened for the duration if it is not open yet.
+		"""
+		for bind_replies, reply in self.__many(param_sets, batch_size, batch_bytes, self.session._EXECUTE):
+			for bind_reply in bind_replies:
+				bind_reply.result()
+			yield reply.result()
+	
+	def results_many(self, param_sets, batch_size=256, batch_bytes=1 << 20):
+		"Like `execute_many`, but yield the results of each parameter set as a list of (typeid, value)."
+		for bind_replies, reply in self.__many(param_sets, batch_size, batch_bytes, self.session._RESULTS_ALL):
+			for bind_reply in bind_replies:
+				bind_reply.result()
+			result = []
+			for typeid, value in reply.result():
+				try:
+					typestr = self.typeids[typeid]
+				except IndexError:
+					typestr = None
+				result.append((typestr, value))
+			yield result
+	
+	def __many(self, param_sets, batch_size, batch_bytes, method):
+		was_open = self.is_open()
+		if not was_open:
+			self.open()
+		
+		try:
+			param_sets = iter(param_sets)
+			while True:
+				replies = []
+				try:
+					with self.session.pipeline():
+						for params in param_sets:
+							bind_replies = []
+							for name, value in params.items():
+								if isinstance(value, tuple):
+									bind_replies.append(self.bind(name, *value))
+								else:
+									bind_replies.append(self.bind(name, value))
+							bind_replies.extend(self.__send_bindings())
+							replies.append((bind_replies, method(self.handle())))
+							if len(replies) >= batch_size or self.session.queued() >= batch_bytes:
+								break
+				except (BaseXQueryError, BaseXCommandError):
+					pass # raised again from the reply it belongs to
+				finally:
+					if replies and self.session.result_cache is not None and self.__is_updating():
+						self.session.result_cache.invalidate()
+				
+				if not replies:
+					break
+				yield from replies
+		finally:
+			if not was_open:
+				self.close()
 	
 	def __enter__(self):
 		"Enter context manager. Use as alternative to open/close."
@@ -12,40 +12,98 @@ if __name__ == '__main__':
 	warnings.filterwarnings('ignore')
 
 
-__all__ = 'Database', 'Table'
+__all__ = 'Database', 'Table', 'AdHocQuery'
 
 
-from collections import defaultdict
+from collections import OrderedDict
 from itertools import chain
 from enum import Enum
+from contextlib import contextmanager, ExitStack
+from threading import Lock, get_ident
 
 if __name__ == '__main__':
-	from basex import Session as BaseXSession, BaseXQueryError
+	from basex import Session as BaseXSession, SessionPool, ResultCache, Spool, BaseXQueryError, BaseXCommandError
 	from locking import locked_ro, locked_rw, MultiLock, Driver, Accessor
 	from xmltype import XMLType, XMLText, XMLAttribute
 else:
-	from .basex import Session as BaseXSession, BaseXQueryError
+	from .basex import Session as BaseXSession, SessionPool, ResultCache, Spool, BaseXQueryError, BaseXCommandError
 	from .locking import locked_ro, locked_rw, MultiLock, Driver, Accessor
 	from .xmltype import XMLType, XMLText, XMLAttribute
 
 
+def as_str(result):
+	"Return a request result as a string. A result the session spooled to a temporary file (see `memory_limit`) is read whole and the file removed."
+	if isinstance(result, Spool):
+		with result:
+			return str(result)
+	return result
+
+
 class Database(BaseXSession, Driver):
-	class Queries(defaultdict):
-		def __init__(self, database):
+	class Queries(OrderedDict):
+		"""
+		Open queries of one session, by query string, opened on first use. At most `capacity` are kept open:
+		the least recently used one is closed to make room for a new one. `hits`, `misses` and `evictions` count the lookups.
+		A closed query that its holder goes on using is prepared again and taken back, so it is closed in its turn.
+		"""
+		
+		def __init__(self, session, capacity):
 			super().__init__()
-			self.database = database
+			self.session = session
+			self.capacity = capacity
+			self.lock = Lock()
+			self.hits = 0
+			self.misses = 0
+			self.evictions = 0
 		
-		def __missing__(self, query_str):
-			query = self.database.query(query_str)
+		def __getitem__(self, query_str):
+			with self.lock:
+				query = self.get(query_str)
+				if query is not None:
+					self.hits += 1
+					self.move_to_end(query_str)
+					return query
+				
+				self.misses += 1
+				evicted = self.__make_room()
+			
+			self.__close(evicted)
+			query = self.session.query(query_str)
 			query.open()
-			super().__setitem__(query_str, query)
+			query.reopened = lambda: self.readmit(query_str, query)
+			with self.lock:
+				super().__setitem__(query_str, query)
 			return query
 		
+		def readmit(self, query_str, query):
+			"Take back an evicted query that has been prepared again by its holder."
+			with self.lock:
+				if self.get(query_str) is query:
+					self.move_to_end(query_str)
+					return
+				evicted = [_query for _query in [self.pop(query_str, None)] if _query is not None] # opened again meanwhile by another lookup
+				evicted.extend(self.__make_room())
+				super().__setitem__(query_str, query)
+			self.__close(evicted)
+		
+		def __make_room(self):
+			evicted = []
+			while len(self) >= self.capacity:
+				evicted.append(self.popitem(last=False)[1])
+				self.evictions += 1
+			return evicted
+		
+		@staticmethod
+		def __close(queries):
+			for query in queries:
+				if query.is_open():
+					query.close()
+		
 		__setitem__ = None
 		
 		def __delitem__(self, query_str):
 			if query_str == Ellipsis:
-				for qs in self.keys():
+				for qs in list(self.keys()):
 					del self[qs]
 			elif query_str in self:
 				query = super().__getitem__(query_str)
@@ -53,21 +111,56 @@ class Database(BaseXSession, Driver):
 					query.close()
 				super().__delitem__(query_str)
 	
-	def __init__(self, arbitrator, host, port, user, password, database_name, xmlns={}, xml_pfx={}):
+	def __init__(self, arbitrator, host, port, user, password, database_name, xmlns={}, xml_pfx={}, pool_size=None, memory_limit=None, query_cache_size=64, prefetch=None, serialization={}, result_cache_size=None, result_cache_ttl=None, timeout=None):
+		"""
+		If `pool_size` is given, database and table operations borrow sessions from a `SessionPool` of that size instead of sharing this one connection.
+		Every session keeps at most `query_cache_size` prepared queries open on the server. See `Session` for `memory_limit`:
+		documents and table values are still returned as strings, spooled results of `AdHocQuery` come as a `Spool`.
+		If `prefetch` is given, table iteration reads the results in a background thread into a queue of that many items (0 for no limit),
+		and gives the session back as soon as they are all read (see `Query.prefetch`).
+		`serialization` holds the serialization parameters of the results of all tables, like `{'indent': False}` (see `Table.output`).
+		If `result_cache_size` is given, the results of read-only queries are cached, at most that many for at most `result_cache_ttl` seconds,
+		and shared by all the sessions of the database (see `ResultCache`). Writes through the database invalidate them.
+		`timeout` is the default deadline in seconds of table operations and ad-hoc queries (see `Table.deadline`).
+		"""
 		Driver.__init__(self, arbitrator)
-		BaseXSession.__init__(self, user, password, (host, port))
+		result_cache = ResultCache(result_cache_size, result_cache_ttl) if result_cache_size else None
+		BaseXSession.__init__(self, user, password, (host, port), memory_limit=memory_limit, result_cache=result_cache)
 		self.database_name = database_name
+		self.query_cache_size = query_cache_size
+		self.updating_queries = {}
+		self.prefetch = prefetch
+		self.timeout = timeout
+		self.serialization = dict(serialization)
 		self.xmlns = dict(xmlns)
 		self.xml_pfx = dict(xml_pfx)
 		try:
 			del self.xmlns['xml']
 		except KeyError:
 			pass
+		
+		if pool_size:
+			self.pool = SessionPool(user, password, (host, port), maxsize=pool_size, setup=self.setup_session, memory_limit=memory_limit, result_cache=result_cache)
+		else:
+			self.pool = None
+		self.borrowed = {} # thread id: pooled session it holds
+	
+	def setup_session(self, session):
+		"Prepare a freshly logged-in session for the operations on this database."
+		session.execute.check(self.database_name)
+		session.queries = self.Queries(session, self.query_cache_size)
+		if session is not self:
+			session.open_side = self.open_side # side connections of pooled sessions are prepared the same way
+	
+	def reconnect(self):
+		"Reconnect (in a forked child, or after a cancelled request), then open the database again. Query handles are prepared again lazily."
+		super().reconnect()
+		if hasattr(self, 'queries'):
+			self.setup_session(self)
 	
 	def __enter__(self):
 		super().__enter__()
-		self.execute.check(self.database_name)
-		self.queries = self.Queries(self)
+		self.setup_session(self)
 		return self
 	
 	def __exit__(self, *args):
@@ -76,10 +169,42 @@ class Database(BaseXSession, Driver):
 				if query.is_open():
 					query.close()
 			self.execute.close()
+		if self.pool is not None:
+			self.pool.close()
 		super().__exit__(*args)
 	
+	def open_side(self):
+		side = super().open_side()
+		self.setup_session(side)
+		return side
+	
+	@contextmanager
+	def borrow(self):
+		"""
+		Session to run one operation on: a pooled one if the database has a pool, otherwise the database connection itself (or its side connection, when nested in a result stream).
+		An operation nested in another one of the same thread runs on the session that one holds, or its side connection, and never waits for the pool.
+		"""
+		thread = get_ident()
+		held = self.borrowed.get(thread)
+		if self.pool is None or held is not None:
+			yield (self if held is None else held).available()
+		else:
+			with self.pool.borrow() as session:
+				self.borrowed[thread] = session
+				try:
+					yield session
+				finally:
+					del self.borrowed[thread] # maybe from another thread, when a prefetch reader gives the session back
+	
+	def query(self, query, *documents):
+		"Return an XQuery helper. Given the documents the query reads or writes, return an `AdHocQuery` that runs it under their locks."
+		if not documents:
+			return super().query(query)
+		return AdHocQuery(self, query, documents)
+	
 	def keys(self):
-		path_lines = self.execute.list_(self.database_name).split('\n')[:-3]
+		with self.borrow() as session:
+			path_lines = as_str(session.execute.list_(self.database_name)).split('\n')[:-3]
 		lim = path_lines[0].index('Type')
 		result = []
 		for line in path_lines[2:]:
@@ -99,20 +224,39 @@ class Database(BaseXSession, Driver):
 	
 	def __getitem__(self, path):
 		try:
-			return self.execute.get(path)
+			with self.borrow() as session:
+				return as_str(session.execute.get(path))
+		except BaseXCommandError:
+			raise KeyError(path)
+	
+	def get_binary(self, path, sink=None):
+		"Fetch the binary resource at `path`: return it as bytes, or write it to `sink` part by part and return the length (see `Session.retrieve`)."
+		try:
+			with self.borrow() as session:
+				return session.retrieve(path, sink)
+		except BaseXCommandError:
+			raise KeyError(path)
+	
+	def stream(self, path):
+		"Yield the document at `path` in parts, as it arrives from the server."
+		try:
+			with self.borrow() as session:
+				yield from session._COMMAND_STREAM(f'GET {path}')
 		except BaseXCommandError:
 			raise KeyError(path)
 	
 	def __setitem__(self, path, content):
-		self.put(path, content)
+		with self.borrow() as session:
+			session.put(path, content)
 	
 	def __delitem__(self, path):
 		try:
-			self.execute.delete(path)
+			with self.borrow() as session:
+				session.execute.delete(path)
 		except BaseXCommandError:
 			raise KeyError(path)
 	
-	def doc(self, document, xmlns={}, xml_pfx={}):
+	def doc(self, document, xmlns={}, xml_pfx={}, serialization={}):
 		table_xmlns = {}
 		table_xmlns.update(self.xmlns)
 		table_xmlns.update(xmlns)
@@ -121,7 +265,11 @@ class Database(BaseXSession, Driver):
 		table_xml_pfx.update(self.xml_pfx)
 		table_xml_pfx.update(xml_pfx)
 		
-		return Table(self, document, (), (), {}, table_xmlns, table_xml_pfx)
+		table_serialization = {}
+		table_serialization.update(self.serialization)
+		table_serialization.update(serialization)
+		
+		return Table(self, document, (), (), {}, table_xmlns, table_xml_pfx, table_serialization, self.timeout)
 	
 	@staticmethod
 	def xml_convert(py_value, xml_pfx):
@@ -142,6 +290,7 @@ class Database(BaseXSession, Driver):
 	
 	@staticmethod
 	def py_convert(type_name, xml_value):
+		xml_value = as_str(xml_value)
 		if type_name in ['xs:integer', 'xs:long', 'xs:int', 'xs:short', 'xs:byte', 'xs:nonNegativeInteger', 'xs:unsignedLong', 'xs:unsignedInt', 'xs:unsignedShort', 'xs:unsignedByte', 'xs:positiveInteger']:
 			return int(xml_value)
 		elif type_name in ['xs:float', 'xs:double', 'xs:decimal', 'xs:precisionDecimal']:
@@ -159,7 +308,7 @@ class Database(BaseXSession, Driver):
 
 
 class Table(Accessor):
-	def __init__(self, database, document, expression_chain, selector_chain, bound_variables, xmlns, xml_pfx):
+	def __init__(self, database, document, expression_chain, selector_chain, bound_variables, xmlns, xml_pfx, serialization={}, timeout=None):
 		super().__init__(database, document, isinstance(document, frozenset))
 		self.database = database
 		self.document = document
@@ -168,6 +317,8 @@ class Table(Accessor):
 		self.bound_variables = bound_variables
 		self.xmlns = xmlns
 		self.xml_pfx = xml_pfx
+		self.serialization = serialization
+		self.timeout = timeout
 		self.__query_string_cache = {}
 	
 	def __truediv__(self, path_element):
@@ -177,7 +328,7 @@ class Table(Accessor):
 			expr_chain = expr_chain + (((path_element,), None, None),)
 		else:
 			expr_chain = expr_chain[:-1] + ((expr_chain[-1][0] + (path_element,), None, None),)
-		return self.__class__(self.database, self.document, expr_chain, self.selector_chain, self.bound_variables, self.xmlns, self.xml_pfx)
+		return self.__class__(self.database, self.document, expr_chain, self.selector_chain, self.bound_variables, self.xmlns, self.xml_pfx, self.serialization, self.timeout)
 	
 	def __matmul__(self, keys_spec):
 		"Expression building helper. Provide keys specification."
@@ -188,12 +339,12 @@ class Table(Accessor):
 			if not keys_spec:
 				keys_spec = [None]
 			expr_chain = expr_chain[:-1] + ((expr_chain[-1][0], tuple(keys_spec), expr_chain[-1][2]),)
-		return self.__class__(self.database, self.document, expr_chain, self.selector_chain, self.bound_variables, self.xmlns, self.xml_pfx)
+		return self.__class__(self.database, self.document, expr_chain, self.selector_chain, self.bound_variables, self.xmlns, self.xml_pfx, self.serialization, self.timeout)
 	
 	def __floordiv__(self, values):
 		bound_variables = dict(self.bound_variables)
 		bound_variables.update(values)
-		return self.__class__(self.database, self.document, self.expression_chain, self.selector_chain, bound_variables, self.xmlns, self.xml_pfx)
+		return self.__class__(self.database, self.document, self.expression_chain, self.selector_chain, bound_variables, self.xmlns, self.xml_pfx, self.serialization, self.timeout)
 	
 	def __mod__(self, filter_spec):
 		"Expression building helper. Apply a filter on the results."
@@ -204,7 +355,23 @@ class Table(Accessor):
 			expr_chain = expr_chain[:-1] + ((expr_chain[-1][0], expr_chain[-1][1], (filter_spec,)),)
 		else:
 			expr_chain = expr_chain[:-1] + ((expr_chain[-1][0], expr_chain[-1][1], expr_chain[-1][2] + (filter_spec,)),)
-		return self.__class__(self.database, self.document, expr_chain, self.selector_chain, self.bound_variables, self.xmlns, self.xml_pfx)
+		return self.__class__(self.database, self.document, expr_chain, self.selector_chain, self.bound_variables, self.xmlns, self.xml_pfx, self.serialization, self.timeout)
+	
+	def output(self, **parameters):
+		"""
+		Expression building helper. Set serialization parameters of the results, added to the query prolog as `declare option output:...`.
+		Underscores in the names stand for hyphens, booleans for yes/no: `table.output(indent=False, omit_xml_declaration=True)`.
+		"""
+		serialization = dict(self.serialization)
+		serialization.update(parameters)
+		return self.__class__(self.database, self.document, self.expression_chain, self.selector_chain, self.bound_variables, self.xmlns, self.xml_pfx, serialization, self.timeout)
+	
+	def deadline(self, timeout):
+		"""
+		Return the same table with a deadline of `timeout` seconds on every operation (None for no limit). An operation still running then
+		is cancelled on the server and raises `BaseXTimeoutError` (see `Session.deadline`); for iteration the time counts until the results are all read.
+		"""
+		return self.__class__(self.database, self.document, self.expression_chain, self.selector_chain, self.bound_variables, self.xmlns, self.xml_pfx, self.serialization, timeout)
 	
 	def __mul__(self, other):
 		"Expression building helper. Create cartesian product of the expressions."
@@ -239,7 +406,7 @@ class Table(Accessor):
 		bound_variables = dict()
 		bound_variables.update(self.bound_variables)
 		bound_variables.update(other.bound_variables)
-		return self.__class__(self.database, documents, expr_chain, (), bound_variables, self.xmlns, self.xml_pfx)
+		return self.__class__(self.database, documents, expr_chain, (), bound_variables, self.xmlns, self.xml_pfx, self.serialization, self.timeout)
 	
 	def __xmlns_decls(self):
 		for prefix, namespace in self.xmlns.items():
@@ -248,6 +415,16 @@ class Table(Accessor):
 			else:
 				yield f'declare namespace {prefix} = "{namespace}";'
 	
+	def __output_decls(self, mode):
+		parameters = {_name.replace('_', '-'): _value for (_name, _value) in chain(self.serialization.items(), self.mode_serialization.get(mode, {}).items())}
+		for name, value in parameters.items():
+			if value is True:
+				value = 'yes'
+			elif value is False:
+				value = 'no'
+			value = str(value).replace('&', '&amp;').replace('"', '&quot;').replace('\n', '&#10;')
+			yield f'declare option output:{name} "{value}";'
+	
 	def __var_decls(self, level=''):
 		for m, vals in enumerate(self.selector_chain):
 			if vals == Ellipsis:
@@ -347,6 +524,10 @@ class Table(Accessor):
 	
 	__Mode = Enum('Table._Table__Mode', 'GET COUNT INSERT DELETE KEYS GETATTR SETATTR')
 	
+	mode_serialization = {
+		__Mode.COUNT: {'item-separator': '\n'} # counts are read from one string, one per line
+	}
+	
 	def __query_string(self, mode):
 		try:
 			return self.__query_string_cache[mode]
@@ -374,7 +555,7 @@ class Table(Accessor):
 		else:
 			raise NotImplementedError(f"Unsupported mode: {mode}.")
 		
-		result = '\n'.join(chain(self.__xmlns_decls(), self.__var_decls(), self.__bound_var_decls(), (['declare variable $inserted external;'] if mode in (self.__Mode.INSERT, self.__Mode.SETATTR) else []) + [self.__query_expr(modifier)]))
+		result = '\n'.join(chain(self.__xmlns_decls(), self.__output_decls(mode), self.__var_decls(), self.__bound_var_decls(), (['declare variable $inserted external;'] if mode in (self.__Mode.INSERT, self.__Mode.SETATTR) else []) + [self.__query_expr(modifier)]))
 		self.__query_string_cache[mode] = result
 		return result
 	
@@ -432,15 +613,18 @@ class Table(Accessor):
 			raise TypeError("End of chain reached.")
 		
 		sel_chain = self.selector_chain + (keys_values,)
-		return self.__class__(self.database, self.document, self.expression_chain, sel_chain, self.bound_variables, self.xmlns, self.xml_pfx)
+		return self.__class__(self.database, self.document, self.expression_chain, sel_chain, self.bound_variables, self.xmlns, self.xml_pfx, self.serialization, self.timeout)
 	
 	@locked_ro
 	def __str__(self):
 		query_str = self.__query_string(self.__Mode.GET)
-		query = self.database.queries[query_str]
-		self.__apply_keys(query)
-		self.__apply_bound_variables(query)
-		result = query.execute()
+		with self.database.borrow() as session, session.deadline(self.timeout):
+			query = session.queries[query_str]
+			with session.pipeline():
+				self.__apply_keys(query)
+				self.__apply_bound_variables(query)
+				result = query.execute()
+		result = as_str(result.result())
 		if not result and not self.__is_slice():
 			raise KeyError("Query returned no result.")
 		return result
@@ -448,50 +632,30 @@ class Table(Accessor):
 	@locked_ro
 	def get_tags(self):
 		query_str = self.__query_string(self.__Mode.GETATTR)
-		query = self.database.queries[query_str]
-		self.__apply_keys(query)
-		self.__apply_bound_variables(query)
-		for typeid, item in query.results():
-			yield self.database.py_convert(typeid, item)
+		with self.database.borrow() as session, session.deadline(self.timeout):
+			query = session.queries[query_str]
+			with session.pipeline():
+				self.__apply_keys(query)
+				self.__apply_bound_variables(query)
+			for typeid, item in query.results():
+				yield self.database.py_convert(typeid, item)
 	
 	@property
 	def tag(self):
 		if self.__is_slice():
 			raise ValueError("The query must refer to 1 element.")
-		
-		over = self.get_tags()
-		finished = False
-		try:		
-			try:
-				result = next(over)
-			except StopIteration:
-				finished = True
-				raise KeyError("Empty result (tag).")
-			
-			try:
-				next(over)
-			except StopIteration:
-				finished = True
-			else:
-				raise ValueError("Result has more than 1 element (tag).")
-			
-			return result
-		finally:
-			if not finished:
-				while True:
-					try:
-						next(over)
-					except StopIteration:
-						break
+		return self.__get_single(self.__Mode.GETATTR, 'tag')
 	
 	@locked_rw
 	def set_tags(self, value):
 		query_str = self.__query_string(self.__Mode.SETATTR)
-		query = self.database.queries[query_str]
-		self.__apply_keys(query)
-		self.__apply_bound_variables(query)
-		self.__apply_value(query, value)
-		query.execute()
+		with self.database.borrow() as session, session.deadline(self.timeout):
+			query = session.queries[query_str]
+			with session.pipeline():
+				self.__apply_keys(query)
+				self.__apply_bound_variables(query)
+				self.__apply_value(query, value)
+				query.execute()
 	
 	@tag.setter
 	def tag(self, value):
@@ -502,62 +666,87 @@ class Table(Accessor):
 	@locked_ro
 	def __iter__(self):
 		query_str = self.__query_string(self.__Mode.GET)		
-		query = self.database.queries[query_str]
-		self.__apply_keys(query)
-		self.__apply_bound_variables(query)
-		for typeid, item in query.results():
-			yield self.database.py_convert(typeid, item)
+		if self.database.prefetch is not None:
+			yield from self.__prefetch(query_str)
+			return
+		
+		with self.database.borrow() as session, session.deadline(self.timeout):
+			query = session.queries[query_str]
+			with session.pipeline():
+				self.__apply_keys(query)
+				self.__apply_bound_variables(query)
+			for typeid, item in query.results():
+				yield self.database.py_convert(typeid, item)
 	
-	def __call__(self):
-		over = iter(self)
-		finished = False
+	def __prefetch(self, query_str):
+		borrowed = ExitStack()
+		session = borrowed.enter_context(self.database.borrow())
 		try:
+			query = session.queries[query_str]
+			with session.pipeline():
+				self.__apply_keys(query)
+				self.__apply_bound_variables(query)
+		except:
+			borrowed.close()
+			raise
+		yield from query.prefetch(self.database.prefetch, self.database.py_convert, borrowed.close, self.timeout) # the reader thread gives the session back
+	
+	def __call__(self):
+		return self.__get_single(self.__Mode.GET, 'call')
+	
+	@locked_ro
+	def __get_single(self, mode, what):
+		"Return the only item of the result, converted. Further items are only detected, never decoded."
+		query_str = self.__query_string(mode)
+		with self.database.borrow() as session, session.deadline(self.timeout):
+			query = session.queries[query_str]
+			with session.pipeline():
+				self.__apply_keys(query)
+				self.__apply_bound_variables(query)
+			results = query.results(raw=True)
 			try:
-				result = next(over)
-			except StopIteration:
-				finished = True
-				raise KeyError("Empty result (call).")
-			
-			try:
-				next(over)
-			except StopIteration:
-				finished = True
-			else:
-				raise ValueError("Result has more than 1 element (call).")
-			
-			return result
-		finally:
-			if not finished:
-				while True:
-					try:
-						next(over)
-					except StopIteration:
-						break
+				try:
+					typeid, item = next(results)
+				except StopIteration:
+					raise KeyError(f"Empty result ({what}).")
+				
+				try:
+					next(results)
+				except StopIteration:
+					pass
+				else:
+					raise ValueError(f"Result has more than 1 element ({what}).")
+			finally:
+				results.close()
+		return self.database.py_convert(typeid, str(item))
 	
 	@locked_ro
 	def __len__(self):
 		if self.__is_slice():
-			query_str = self.__query_string(self.__Mode.COUNT)
-			query = self.database.queries[query_str]
-			self.__apply_keys(query)
-			self.__apply_bound_variables(query)
-			return sum(int(_l) for _l in query.execute().split('\n') if _l)
+			final = self
 		else:
 			final = self[...]
-			query_str = final.__query_string(self.__Mode.COUNT)
-			query = final.database.queries[query_str]
-			final.__apply_keys(query)
-			final.__apply_bound_variables(query)
-			return sum(int(_l) for _l in query.execute().split('\n') if _l)
+		
+		query_str = final.__query_string(self.__Mode.COUNT)
+		with self.database.borrow() as session, session.deadline(self.timeout):
+			query = session.queries[query_str]
+			with session.pipeline():
+				final.__apply_keys(query)
+				final.__apply_bound_variables(query)
+				result = query.execute()
+		return sum(int(_l) for _l in as_str(result.result()).split('\n') if _l)
 	
 	@locked_ro
 	def __contains__(self, keys_values):
 		final = self[keys_values]
 		query_str = final.__query_string(self.__Mode.COUNT)
-		query = final.database.queries[query_str]
-		final.__apply_keys(query)
-		final.__apply_bound_variables(query)
-		return bool(sum(int(_l) for _l in query.execute().split('\n') if _l))
+		with self.database.borrow() as session, session.deadline(self.timeout):
+			query = session.queries[query_str]
+			with session.pipeline():
+				final.__apply_keys(query)
+				final.__apply_bound_variables(query)
+				result = query.execute()
+		return bool(sum(int(_l) for _l in as_str(result.result()).split('\n') if _l))
 	
 	@locked_ro
 	def keys(self):
@@ -565,17 +754,19 @@ class Table(Accessor):
 		l = len(self.expression_chain[len(self.selector_chain)][1])
 		final = self[...]
 		query_str = final.__query_string(self.__Mode.KEYS)
-		query = final.database.queries[query_str]
-		final.__apply_keys(query)
-		final.__apply_bound_variables(query)
-		for typeid, item in query.results():
-			r.append(self.database.py_convert(typeid, item))
-			if len(r) == l:
-				if l == 1:
-					yield r[0]
-				else:
-					yield tuple(r)
-				r.clear()
+		with self.database.borrow() as session, session.deadline(self.timeout):
+			query = session.queries[query_str]
+			with session.pipeline():
+				final.__apply_keys(query)
+				final.__apply_bound_variables(query)
+			for typeid, item in query.results():
+				r.append(self.database.py_convert(typeid, item))
+				if len(r) == l:
+					if l == 1:
+						yield r[0]
+					else:
+						yield tuple(r)
+					r.clear()
 		assert not r
 	
 	def values(self):
@@ -592,35 +783,45 @@ class Table(Accessor):
 	@locked_rw
 	def __setitem__(self, keys_values, values):
 		final = self[keys_values]
-		query_str = final.__query_string(self.__Mode.DELETE)
-		query = final.database.queries[query_str]
-		final.__apply_keys(query)
-		final.__apply_bound_variables(query)
-		query.execute()
-		
-		query_str = self.__query_string(self.__Mode.INSERT)
-		query = self.database.queries[query_str]
-		if final.__is_slice():
-			for value in values:
-				self.__apply_keys(query)
-				self.__apply_bound_variables(query)
-				self.__apply_value(query, value)
-				query.execute()
-		else:
-			self.__apply_keys(query)
-			self.__apply_bound_variables(query)
-			self.__apply_value(query, values)
-			query.execute()
+		with self.database.borrow() as session, session.deadline(self.timeout):
+			delete_query = session.queries[final.__query_string(self.__Mode.DELETE)]
+			insert_query = session.queries[self.__query_string(self.__Mode.INSERT)]
+			with session.pipeline():
+				final.__apply_keys(delete_query)
+				final.__apply_bound_variables(delete_query)
+				deleted = delete_query.execute()
+			deleted.result() # a failed delete must not be followed by the inserts
+			
+			with session.pipeline():
+				if final.__is_slice():
+					for value in values:
+						self.__apply_keys(insert_query)
+						self.__apply_bound_variables(insert_query)
+						self.__apply_value(insert_query, value)
+						insert_query.execute()
+				else:
+					self.__apply_keys(insert_query)
+					self.__apply_bound_variables(insert_query)
+					self.__apply_value(insert_query, values)
+					insert_query.execute()
 	
 	@locked_rw
 	def __delitem__(self, keys_values):
 		final = self[keys_values]
 		query_str = final.__query_string(self.__Mode.DELETE)
-		query = final.database.queries[query_str]
-		final.__apply_keys(query)
-		final.__apply_bound_variables(query)
-		result = query.execute() # TODO: check result
-		if not result and not self.__is_slice():
+		with self.database.borrow() as session, session.deadline(self.timeout):
+			query = session.queries[query_str]
+			with session.pipeline():
+				final.__apply_keys(query)
+				final.__apply_bound_variables(query)
+				result = query.execute()
+		result = result.result() # TODO: check result
+		if isinstance(result, Spool):
+			with result: # only whether anything was deleted matters
+				empty = not len(result)
+		else:
+			empty = not result
+		if empty and not self.__is_slice():
 			raise KeyError("Query returned no result.")
 	
 	def get_attr(self, attr, type_):
@@ -630,10 +831,102 @@ class Table(Accessor):
 		raise NotImplementedError(f"set_attr({attr}, {value})")
 
 
+class AdHocQuery(Accessor):
+	"""
+	Arbitrary XQuery on the database, run under the locks of the documents it names, like the `Table` operations. Obtained from `Database.query`.
+	The server tells once per query string whether the query is updating (see `Query.updating`); the database remembers it.
+	Read-only queries then share the documents with other readers, updating ones wait for exclusive access.
+	
+	```
+		query = database.query('count(doc("one.xml")//one[title = $title])', 'one.xml')
+		print(query.execute({'$title': 'First'}))
+	```
+	
+	Bindings map variable names to values, or to (value, type) pairs. The deadline of the database applies (see `Table.deadline`).
+	"""
+	
+	def __init__(self, database, query, documents):
+		lock_key = documents[0] if len(documents) == 1 else frozenset(documents)
+		super().__init__(database, lock_key, isinstance(lock_key, frozenset))
+		self.database = database
+		self.query = query
+		self.timeout = database.timeout
+	
+	def updating(self):
+		"Check if the query is updating. The server is only asked the first time."
+		try:
+			return self.database.updating_queries[self.query]
+		except KeyError:
+			pass
+		
+		with self.database.borrow() as session:
+			updating = session.queries[self.query].updating()
+		self.database.updating_queries[self.query] = updating
+		return updating
+	
+	def execute(self, bindings={}):
+		"Return the result of the query as one big string."
+		if self.updating():
+			return self.__execute_rw(bindings)
+		else:
+			return self.__execute_ro(bindings)
+	
+	def results(self, bindings={}):
+		"Yield results one by one as (typeid, value)."
+		if self.updating():
+			return self.__results_rw(bindings)
+		else:
+			return self.__results_ro(bindings)
+	
+	__call__ = execute
+	
+	@locked_ro
+	def __execute_ro(self, bindings):
+		return self.__execute(bindings)
+	
+	@locked_rw
+	def __execute_rw(self, bindings):
+		return self.__execute(bindings)
+	
+	@locked_ro
+	def __results_ro(self, bindings):
+		yield from self.__results(bindings)
+	
+	@locked_rw
+	def __results_rw(self, bindings):
+		yield from self.__results(bindings)
+	
+	def __execute(self, bindings):
+		with self.database.borrow() as session, session.deadline(self.timeout):
+			query = session.queries[self.query]
+			with session.pipeline():
+				self.__apply_bindings(query, bindings)
+				result = query.execute()
+		return result.result()
+	
+	def __results(self, bindings):
+		with self.database.borrow() as session, session.deadline(self.timeout):
+			query = session.queries[self.query]
+			with session.pipeline():
+				self.__apply_bindings(query, bindings)
+			yield from query.results()
+	
+	@staticmethod
+	def __apply_bindings(query, bindings):
+		for name, value in bindings.items():
+			if isinstance(value, tuple):
+				query.bind(name, *value)
+			else:
+				query.bind(name, value)
+
+
 if __debug__ and __name__ == '__main__':
 	from multiprocessing import Manager
 	from locking import Arbitrator
 	from time import clock_gettime_ns, CLOCK_MONOTONIC
+	import gc
+	from threading import Thread
+	from fakeserver import FakeServer
 	#from pycallgraph2 import PyCallGraph
 	#from pycallgraph2.output import GraphvizOutput
 	
@@ -643,6 +936,99 @@ if __debug__ and __name__ == '__main__':
 	arbitrator = Arbitrator(Manager())
 	arbitrator.prepare_namespace()
 	
+	def check_query_cache():
+		with FakeServer() as server:
+			with Database(arbitrator, *server.address, 'admin', 'admin', 'test', query_cache_size=1) as database:
+				table = database.doc('one.xml') / 'root' / 'one' @ ['title/text()']
+				for n in range(10):
+					table['First'] = 'First' # the delete query is evicted by the insert query while held
+				assert server.open_queries == 1
+		
+		with FakeServer(query=lambda _text, _bindings, _context: [_bindings['$a'][0] if '$a' in _bindings else _text]) as server:
+			with Database(arbitrator, *server.address, 'admin', 'admin', 'test', query_cache_size=1) as database:
+				query = database.queries['echo']
+				query.bind('$a', 'bound')
+				database.queries['other'] # evicts the first query
+				assert query.execute() == 'bound' # prepared again with its binding
+	
+	def check_pool():
+		with FakeServer(query=lambda _text, _bindings, _context: [('element()', '<one/>')] * 3) as server:
+			with Database(arbitrator, *server.address, 'admin', 'admin', 'test', pool_size=1) as database:
+				table = database.doc('one.xml') / 'root' / 'one'
+				
+				def nested():
+					for _x in table:
+						for _y in table: # borrows while the outer loop holds the only pooled session
+							pass
+				
+				threads = [Thread(target=nested, daemon=True) for _n in range(4)]
+				for thread in threads:
+					thread.start()
+				for thread in threads:
+					thread.join(10)
+					assert not thread.is_alive(), "nested borrow waits for the pool"
+				assert database.pool.size == 1 and not database.borrowed
+	
+	def check_spool():
+		def query(text, bindings, context):
+			return ['3'] if 'count(' in text else [('element()', '<one>' + 'x' * 10000 + '</one>')]
+		
+		def command(text):
+			if text.startswith('LIST'):
+				return 'Input Path'.ljust(40) + 'Type\n' + '-' * 50 + '\n' + ''.join(f'{_n}.xml'.ljust(40) + 'xml\n' for _n in range(100)) + '\n100 Resources.\n'
+			elif text.startswith('GET'):
+				return 'y' * 10000
+			return ''
+		
+		with FakeServer(query=query, command=command) as server:
+			with Database(arbitrator, *server.address, 'admin', 'admin', 'test', memory_limit=1000) as database:
+				table = database.doc('one.xml') / 'root' / 'one' @ ['title/text()']
+				assert str(table['First']) == '<one>' + 'x' * 10000 + '</one>'
+				assert len(table) == 3 and 'First' in table
+				assert [type(_one) for _one in table] == [XMLType] # iterated items are spooled too, and read back to be parsed
+				assert database.keys() == [f'{_n}.xml' for _n in range(100)]
+				assert database['one.xml'] == 'y' * 10000
+				
+				with warnings.catch_warnings(record=True) as caught:
+					warnings.simplefilter('always', ResourceWarning)
+					del table['First'] # the big output of the delete query is spooled
+					gc.collect()
+				assert not [_warning for _warning in caught if issubclass(_warning.category, ResourceWarning)], "Spool left open."
+	
+	def check_prefetch_cache():
+		for pool_size in None, 1:
+			with FakeServer(query=lambda _text, _bindings, _context: ['3'] if 'count(' in _text else ['First', 'Second', 'Third']) as server:
+				with Database(arbitrator, *server.address, 'admin', 'admin', 'test', pool_size=pool_size, prefetch=2, result_cache_size=16) as database:
+					table = database.doc('one.xml') / 'root' / 'one' @ ['title/text()']
+					assert list(table) == list(table) == ['First', 'Second', 'Third'] # the second time from the cache
+					table['First'] = 'First' # the session is not left marked as streaming
+	
+	def check_replace():
+		calls = []
+		
+		def query(text, bindings, context):
+			if 'delete node' in text:
+				calls.append('delete')
+				raise ValueError("Delete failed on purpose.")
+			elif 'insert node' in text:
+				calls.append('insert')
+			return []
+		
+		with FakeServer(query=query) as server:
+			with Database(arbitrator, *server.address, 'admin', 'admin', 'test') as database:
+				table = database.doc('one.xml') / 'root' / 'one' @ ['title/text()']
+				try:
+					table['First'] = 'First'
+				except BaseXQueryError:
+					pass
+				else:
+					assert False, "Delete error not raised."
+				assert calls == ['delete'] # the new row is not inserted next to the old one
+	
+	for check in check_pool, check_spool, check_query_cache, check_prefetch_cache, check_replace:
+		check()
+		print(f"{check.__name__}: ok")
+	
 	XMLType.xmlns['baxend'] = 'https://github.com/haael/baxend'
 	XMLType.xml_pfx['https://github.com/haael/baxend'] = ''
 	XMLType.xml_pfx['other'] = 'other'
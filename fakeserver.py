@@ -0,0 +1,548 @@
+#!/usr/bin/python3.11
+#-*- coding: utf-8 -*-
+
+"""
+In-process stand-in for a BaseX server, for load tests of the client side.
+
+Speaks the server protocol: login handshake, commands, QUERY, BIND, CONTEXT, RESULTS, EXECUTE, FULL, INFO, OPTIONS, UPDATING, CLOSE,
+CREATE, ADD, PUT and STORE. What the queries and commands return is decided by pluggable Python callables;
+the latency and the bandwidth of the responses are configurable.
+
+```
+	def query(text, bindings, context):
+		if text == 'count':
+			return [('xs:integer', '3')]
+		return sized_items(100, 1000) # 100 items of 1000 characters
+	
+	with FakeServer(query=query, latency=lambda: random.expovariate(2000), bandwidth=100 << 20) as server:
+		with Session('admin', 'admin', server.address) as session:
+			print(session.query('count')())
+```
+"""
+
+
+from logging import getLogger, basicConfig, DEBUG
+log = getLogger(__name__)
+
+if __name__ == '__main__':
+	basicConfig(level=DEBUG, format='%(asctime)-8s %(levelname)-8s %(name)-32s %(message)s')
+	
+	import warnings
+	warnings.filterwarnings('ignore')
+
+
+__all__ = 'FakeServer', 'sized_items'
+
+
+import re
+import socket
+from time import sleep
+from threading import Thread, Lock
+from itertools import count
+from hashlib import md5
+from socketserver import ThreadingTCPServer, BaseRequestHandler
+
+if not __package__: # run, or imported by the checks of another module run as a script
+	from basex import Session, Query, escape, unescape
+else:
+	from .basex import Session, Query, escape, unescape
+
+
+def sized_items(number, size, text='x'):
+	"Generate `number` string items of `size` characters each, for result size tests."
+	item = (text * (size // len(text) + 1))[:size]
+	for n in range(number):
+		yield item
+
+
+class FakeServer:
+	"""
+	Fake BaseX server listening on a local port, serving every connection in its own thread.
+	
+	`query(text, bindings, context)` is called when a query is executed: `bindings` maps the bound variable names to `(value, type)`,
+	`context` is the bound context value or None. It returns an iterable of items: strings, or `(type, string)` pairs
+	where the type is a name from `Query.typeids` (e.g. 'element()'), the default is 'xs:string'.
+	`command(text)` is called for a database command and returns the result as a string (or bytes, which are escaped as raw data, like RETRIEVE).
+	Either of them reports an error by raising an exception, whose message is sent to the client.
+	`updating(text)` answers the UPDATING request.
+	
+	`latency` (seconds, or a callable returning seconds) delays every response, `bandwidth` (bytes per second) limits its transfer.
+	With `tls_context` (a server side `ssl.SSLContext`), connections are encrypted.
+	Resources uploaded by CREATE, ADD, PUT and STORE are kept in `documents` (path to bytes); the default command handler
+	serves them back to GET and RETRIEVE. `open_queries` counts the queries prepared and not closed yet, over all connections.
+	"""
+	
+	realm = 'BaseX'
+	send_size = 1 << 16
+	updating_expression = re.compile(r'\b(insert|delete|replace|rename)\s+node\b|\bdb:(create|drop|add|delete|put|replace|rename|store|optimize)\(')
+	
+	class Server(ThreadingTCPServer):
+		daemon_threads = True
+		allow_reuse_address = True
+		
+		def __init__(self, address, family, fake):
+			self.address_family = family
+			self.fake = fake
+			super().__init__(address, FakeServer.Handler)
+	
+	class Handler(BaseRequestHandler):
+		def handle(self):
+			self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			sock = self.request
+			tls_context = self.server.fake.tls_context
+			if tls_context is not None:
+				try:
+					sock = tls_context.wrap_socket(sock, server_side=True)
+				except OSError as error:
+					log.info(f"TLS handshake failed: {error}")
+					return
+			FakeServer.Connection(self.server.fake, sock).run()
+	
+	class Connection:
+		"One client connection: the request parser and the state of its queries."
+		
+		def __init__(self, fake, sock):
+			self.fake = fake
+			self.sock = sock
+			self.buffer = bytearray()
+			self.position = 0
+			self.queries = {}
+			self.query_ids = count(1)
+		
+		def fill(self):
+			if self.position:
+				del self.buffer[:self.position]
+				self.position = 0
+			data = self.sock.recv(1 << 16)
+			if not data:
+				raise EOFError
+			self.buffer += data
+		
+		def recv_byte(self):
+			while self.position >= len(self.buffer):
+				self.fill()
+			self.position += 1
+			return self.buffer[self.position - 1]
+		
+		def recv_bytes(self):
+			"Read data up to the terminator, unescaped."
+			while True:
+				end = self.buffer.find(0, self.position)
+				while end > 0 and self.__escaped(end):
+					end = self.buffer.find(0, end + 1)
+				if end >= 0:
+					break
+				self.fill()
+			data = unescape(bytes(self.buffer[self.position:end]))
+			self.position = end + 1
+			return data
+		
+		def __escaped(self, end):
+			"Check if the zero byte at `end` is escaped, that is preceded by an odd number of 0xFF bytes."
+			start = end
+			while start > self.position and self.buffer[start - 1] == 0xff:
+				start -= 1
+			return (end - start) % 2 == 1
+		
+		def recv_str(self):
+			return self.recv_bytes().decode('utf-8')
+		
+		def run(self):
+			nonce = str(id(self))
+			self.send(f'{self.fake.realm}:{nonce}'.encode('utf-8') + b'\0')
+			try:
+				user = self.recv_str()
+				digest = self.recv_str()
+				password = self.fake.users.get(user)
+				expected = md5((md5(f'{user}:{self.fake.realm}:{password}'.encode('utf-8')).hexdigest() + nonce).encode('utf-8')).hexdigest()
+				if password is None or digest != expected:
+					self.send(b'\1')
+					return
+				self.send(b'\0')
+				
+				while True:
+					response = self.dispatch(self.recv_byte())
+					if response is None:
+						return
+					self.send(response)
+			except (EOFError, ConnectionError):
+				pass
+			finally:
+				self.fake.count_queries(-len(self.queries)) # dropped with the connection
+		
+		def send(self, data):
+			fake = self.fake
+			latency = fake.latency() if callable(fake.latency) else fake.latency
+			if latency:
+				sleep(latency)
+			if fake.bandwidth:
+				for start in range(0, len(data), fake.send_size):
+					part = data[start:start + fake.send_size]
+					self.sock.sendall(part)
+					sleep(len(part) / fake.bandwidth)
+			else:
+				self.sock.sendall(data)
+		
+		@staticmethod
+		def string(s):
+			return s.encode('utf-8') + b'\0'
+		
+		@classmethod
+		def error(cls, exception):
+			return b'\0\1' + cls.string(str(exception) or exception.__class__.__name__)
+		
+		def items(self, id_):
+			"Run the query handler. Return the list of (typeid, text) or raise the handler's exception."
+			text, bindings, context = self.queries[id_]
+			items = []
+			for item in self.fake.query(text, bindings, context):
+				if isinstance(item, tuple):
+					type_, item = item
+				else:
+					type_ = 'xs:string'
+				items.append((Query.typeids.index(type_), str(item)))
+			return items
+		
+		def dispatch(self, opcode):
+			if opcode == 0x0: # QUERY
+				id_ = str(next(self.query_ids))
+				self.queries[id_] = [self.recv_str(), {}, None]
+				self.fake.count_queries(1)
+				return self.string(id_) + b'\0'
+			
+			elif opcode == 0x2: # CLOSE
+				if self.queries.pop(self.recv_str(), None) is not None:
+					self.fake.count_queries(-1)
+				return b'\0\0'
+			
+			elif opcode == 0x3: # BIND
+				id_, name, value, type_ = self.recv_str(), self.recv_str(), self.recv_str(), self.recv_str()
+				self.queries[id_][1][name] = value, type_
+				return b'\0\0'
+			
+			elif opcode == 0xe: # CONTEXT
+				id_, value, type_ = self.recv_str(), self.recv_str(), self.recv_str()
+				self.queries[id_][2] = value, type_
+				return b'\0\0'
+			
+			elif opcode in (0x4, 0x5, 0x1f): # RESULTS, EXECUTE, FULL
+				id_ = self.recv_str()
+				try:
+					items = self.items(id_)
+				except Exception as exception:
+					return self.error(exception)
+				if opcode == 0x5:
+					return self.string('\n'.join(_text for _typeid, _text in items)) + b'\0'
+				elif opcode == 0x4:
+					return b''.join(bytes([_typeid]) + self.string(_text) for _typeid, _text in items) + b'\0\0'
+				else:
+					return b''.join(bytes([_typeid]) + (self.string('') if _typeid in (12, 14, 82) else b'') + self.string(_text) for _typeid, _text in items) + b'\0\0'
+			
+			elif opcode in (0x6, 0x7): # INFO, OPTIONS
+				self.recv_str()
+				return b'\0\0'
+			
+			elif opcode == 0x1e: # UPDATING
+				text = self.queries[self.recv_str()][0]
+				return self.string('true' if self.fake.updating(text) else 'false') + b'\0'
+			
+			elif opcode in (0x8, 0x9, 0xc, 0xd): # CREATE, ADD, PUT, STORE
+				if opcode == 0x9:
+					self.recv_str()
+				path = self.recv_str()
+				self.fake.documents[path] = self.recv_bytes()
+				return b'\0\0'
+			
+			else: # command, the opcode is its first byte
+				self.position -= 1
+				command = self.recv_str()
+				if command == 'EXIT':
+					self.sock.sendall(b'\0\0\0')
+					return None
+				try:
+					result = self.fake.command(command)
+				except Exception as exception:
+					return b'\0' + self.string(str(exception)) + b'\1'
+				if isinstance(result, str):
+					result = result.encode('utf-8')
+				else:
+					result = escape(bytes(result))
+				return result + b'\0\0\0'
+	
+	def __init__(self, query=None, command=None, updating=None, users={'admin': 'admin'}, latency=0, bandwidth=None, address=('::1', 0), family=socket.AF_INET6, tls_context=None):
+		self.query = query if query is not None else self.default_query
+		self.command = command if command is not None else self.default_command
+		self.updating = updating if updating is not None else self.default_updating
+		self.users = dict(users)
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self.tls_context = tls_context
+		self.documents = {}
+		self.open_queries = 0
+		self.lock = Lock()
+		self.server = self.Server(address, family, self)
+		self.thread = None
+	
+	def count_queries(self, n):
+		with self.lock:
+			self.open_queries += n
+	
+	def default_query(self, text, bindings, context):
+		return [text]
+	
+	def default_command(self, command):
+		name, _, argument = command.partition(' ')
+		if name.upper() == 'GET':
+			return self.documents[argument].decode('utf-8')
+		elif name.upper() == 'RETRIEVE':
+			return self.documents[argument]
+		return ''
+	
+	def default_updating(self, text):
+		return self.updating_expression.search(text) is not None
+	
+	@property
+	def address(self):
+		return self.server.server_address[:2]
+	
+	def start(self):
+		"Serve in a background thread."
+		self.thread = Thread(target=self.server.serve_forever, daemon=True)
+		self.thread.start()
+	
+	def close(self):
+		if self.thread is not None:
+			self.server.shutdown()
+			self.thread = None
+		self.server.server_close()
+	
+	def __enter__(self):
+		self.start()
+		return self
+	
+	def __exit__(self, *args):
+		self.close()
+
+
+if __debug__ and __name__ == '__main__':
+	import os
+	import io
+	import ssl
+	import subprocess
+	from tempfile import TemporaryDirectory
+	from time import perf_counter
+	from threading import active_count
+	from logging import WARNING
+	from basex import SessionPool, ResultCache, Spool, BaseXProtocolError, BaseXTimeoutError
+	
+	getLogger().setLevel(WARNING) # the checks move megabytes, protocol dumps would drown them
+	
+	def echo(text, bindings, context):
+		return [bindings['$a'][0] if '$a' in bindings else text]
+	
+	def check_pipeline():
+		with FakeServer(query=echo) as server:
+			with Session('admin', 'admin', server.address) as session:
+				with session.query('echo') as query:
+					with session.pipeline():
+						query.bind('$a', 1)
+						first = query.execute()
+						query.bind('$a', 2)
+						second = query.execute()
+					assert (first.result(), second.result()) == ('1', '2')
+				
+				assert list(session.execute_many('echo', ({'$a': _n} for _n in range(1000)))) == [str(_n) for _n in range(1000)]
+				assert list(session.results_many('echo', [{'$a': 'x'}])) == [[('xs:string', 'x')]]
+				
+				big = 'x' * 200000 # requests and replies both overflow the socket buffers
+				assert all(_result == big for _result in session.execute_many('echo', ({'$a': big} for _n in range(60))))
+		
+		with FakeServer(query=echo) as server:
+			with Session('admin', 'admin', server.address, statistics=True) as session:
+				assert all(_result == big for _result in session.execute_many('echo', ({'$a': big} for _n in range(60)), batch_bytes=1 << 20))
+				assert session.stats()['pipeline']['calls'] >= 60 * len(big) // (1 << 20) # batches bounded by bytes, not only by count
+	
+	def check_pool():
+		with FakeServer() as server:
+			with SessionPool('admin', 'admin', server.address, maxsize=2) as pool:
+				with pool.borrow() as first:
+					with pool.borrow() as second:
+						assert first is not second
+				with pool.borrow() as again:
+					assert again in (first, second)
+				try:
+					with pool.borrow() as broken:
+						raise BaseXProtocolError("Broken on purpose.")
+				except BaseXProtocolError:
+					pass
+				assert pool.size == 1 and broken not in [_session for (_session, _since) in pool.idle]
+	
+	def check_result_cache():
+		calls = []
+		
+		def query(text, bindings, context):
+			calls.append(text)
+			return echo(text, bindings, context)
+		
+		with FakeServer(query=query) as server:
+			cache = ResultCache(ttl=60)
+			with Session('admin', 'admin', server.address, result_cache=cache) as session:
+				with session.query('lookup') as lookup, session.query('delete node //x') as update:
+					for n in range(100):
+						lookup.bind('$a', n % 2)
+						assert lookup.execute() == str(n % 2)
+					assert len(calls) == 2
+					
+					update.execute()
+					lookup.bind('$a', 0)
+					assert lookup.execute() == '0'
+					assert len(calls) == 4
+					
+					for n in range(1000):
+						lookup.bind('$a', n % 2)
+						lookup.context(str(n % 2))
+						lookup.execute()
+					assert len(lookup.unsent) == 2 # only the latest pending binding per name and context
+					
+					lookup.bind('$a', 0)
+					lookup.context('0')
+					session.execute.check('test')
+					session.execute.open_('test')
+					session.execute.set('serializer', 'indent=no')
+					assert lookup.execute() == '0' and len(calls) == 6 # commands that leave the data as it is keep the cache
+					session.execute.delete('x.xml')
+					assert lookup.execute() == '0' and len(calls) == 7
+			assert cache.stats()['hits'] == 98 + 998 + 1
+	
+	def check_deadline():
+		commands = []
+		
+		def query(text, bindings, context):
+			if text == 'slow':
+				sleep(2)
+			return [text]
+		
+		def command(text):
+			commands.append(text)
+			return ''
+		
+		with FakeServer(query=query, command=command) as server:
+			with Session('admin', 'admin', server.address) as session:
+				start = perf_counter()
+				with session.query('slow') as slow:
+					try:
+						slow.execute(timeout=0.2)
+					except BaseXTimeoutError:
+						pass
+					else:
+						assert False, "Deadline not enforced."
+				assert perf_counter() - start < 1
+				assert commands[-1].startswith('KILL ')
+				assert session.query('fast')() == 'fast'
+				
+				threads = active_count()
+				with session.query('fast') as fast:
+					for n in range(100):
+						assert fast.execute(timeout=60) == 'fast'
+				assert active_count() <= threads # one watchdog thread for all deadlines, not a timer per call
+				
+				connections = session.connections
+				with session.deadline(0.1):
+					sleep(0.5) # expires between requests
+				assert session.connections == connections + 1 and not session.cancelled # reconnected before leaving the block
+				assert session.query('fast')() == 'fast'
+	
+	def check_transfer():
+		data = bytes(range(256)) * 4096 # every byte value, escapes included
+		text = 'zażółć gęślą jaźń ' * 50000
+		with FakeServer(query=lambda _text, _bindings, _context: sized_items(100, 10000, 'ź')) as server:
+			with Session('admin', 'admin', server.address) as session:
+				session.put_binary('blob', iter([data[:1000], data[1000:]]))
+				assert server.documents['blob'] == data
+				assert session.retrieve('blob') == data
+				buffer = bytearray(len(data))
+				assert session.retrieve_into('blob', buffer) == len(data) and buffer == data
+				for blob in b'a' * (1 << 20), b'a' * 300000 + b'\0\xff' + b'b' * 300000: # no escapes at all, a single one in the middle
+					server.documents['blob'] = blob
+					assert session.retrieve('blob') == blob
+				
+				session.put('doc.xml', io.StringIO(text))
+				assert server.documents['doc.xml'] == text.encode('utf-8')
+				
+				def failing(size):
+					yield b'a' * size
+					raise ValueError("Input failed on purpose.")
+				
+				for size in 10, 3 << 20: # before and after the first part is sent
+					try:
+						session.put_binary('broken', failing(size))
+					except ValueError:
+						pass
+					session.put('after.xml', '<a/>') # on a new connection, nothing of the broken upload goes with it
+					assert server.documents['after.xml'] == b'<a/>' and 'broken' not in server.documents
+				
+				with session.query('items') as query:
+					assert ''.join(query.stream()) == query.execute()
+					assert [str(_item) for (_type, _item) in query.results(raw=True)] == [_item for (_type, _item) in query.results()]
+	
+	def check_spool():
+		with FakeServer(query=lambda _text, _bindings, _context: sized_items(1, 100000 if _text == 'big' else 100, 'ż')) as server:
+			with Session('admin', 'admin', server.address, memory_limit=1000) as session:
+				with session.query('big') as query:
+					with query.execute() as result:
+						assert isinstance(result, Spool) and len(result) == 200000
+						assert str(result) == ''.join(result) == result.open().read() == 'ż' * 100000
+				with session.query('small') as query:
+					assert query.execute() == 'ż' * 100
+				with session.query('big') as query:
+					[(_type, item)] = query.results() # one item over the limit is spooled too
+					with item:
+						assert isinstance(item, Spool) and str(item) == 'ż' * 100000
+				with session.query('small') as query:
+					assert list(query.results()) == [('xs:string', 'ż' * 100)]
+		
+		with FakeServer(query=lambda _text, _bindings, _context: sized_items(2, 1 << 22)) as server:
+			with Session('admin', 'admin', server.address) as session:
+				with session.query('huge') as query:
+					assert [len(_item) for (_type, _item) in query.results()] == [1 << 22] * 2 # items longer than the input buffer
+	
+	def check_tls():
+		with TemporaryDirectory() as directory:
+			cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+			try:
+				subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost', '-keyout', key, '-out', cert], check=True, capture_output=True)
+			except (OSError, subprocess.CalledProcessError) as error:
+				print(f"check_tls: skipped, no test certificate ({error})")
+				return
+			server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+			server_context.load_cert_chain(cert, key)
+			client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+			client_context.check_hostname = False # the certificate names localhost, the server listens on ::1
+			client_context.load_verify_locations(cert)
+		
+		with FakeServer(query=echo, tls_context=server_context) as server:
+			with Session('admin', 'admin', server.address, tls_context=client_context) as session:
+				assert not session.tls_resumed()
+			with Session('admin', 'admin', server.address, tls_context=client_context) as session:
+				assert session.tls_resumed() # the second connection resumes the TLS session of the first
+				big = 'x' * 200000
+				assert all(_result == big for _result in session.execute_many('echo', ({'$a': big} for _n in range(30))))
+				with session.query('echo') as query:
+					replies = []
+					with session.pipeline():
+						for n in range(50):
+							query.bind('$a', n)
+							replies.append(query.execute())
+					assert [_reply.result() for _reply in replies] == [str(_n) for _n in range(50)]
+	
+	for check in check_pipeline, check_pool, check_result_cache, check_deadline, check_transfer, check_spool, check_tls:
+		check()
+		print(f"{check.__name__}: ok")
+	
+	with FakeServer(query=lambda _text, _bindings, _context: sized_items(10, 100)) as server:
+		with Session('admin', 'admin', server.address) as session:
+			with session.query('items') as query:
+				start = perf_counter()
+				for n in range(10000):
+					list(query.results())
+				print(f"{10000 / (perf_counter() - start):.0f} requests per second")
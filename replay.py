@@ -0,0 +1,285 @@
+#!/usr/bin/python3.11
+#-*- coding: utf-8 -*-
+
+"""
+Wire traffic recorder and replay stub server, for benchmarking the client side without a live BaseX.
+
+Attach a `Recorder` to a session before it connects. Every connection it opens is captured as a track:
+the exact bytes sent and received, split into exchanges (a request and the response that followed it), with timing.
+`ReplayServer` listens on a local port and plays a recording back to whatever connects, with the original or scaled timing.
+Each new connection gets the next track, starting over after the last one.
+
+```
+	with Recorder('session.rec') as recorder:
+		session = Session('user', 'password', ('::1', 1984))
+		recorder.attach(session)
+		with session:
+			run_workload(session)
+	
+	with ReplayServer('session.rec', speed=None) as server: # no delays, measure the client alone
+		with Session('user', 'password', server.address) as session:
+			run_workload(session)
+```
+
+The recording holds the plaintext protocol, replay is over plain TCP. The login of the replayed session must use
+the same user and password, and the workload must send the same requests, which are matched byte by byte.
+"""
+
+
+from logging import getLogger, basicConfig, DEBUG
+log = getLogger(__name__)
+
+if __name__ == '__main__':
+	basicConfig(level=DEBUG, format='%(asctime)-8s %(levelname)-8s %(name)-32s %(message)s')
+	
+	import warnings
+	warnings.filterwarnings('ignore')
+
+
+__all__ = 'Recorder', 'Recording', 'ReplayServer'
+
+
+import socket
+import struct
+from time import perf_counter, sleep
+from threading import Thread, Lock
+from itertools import count
+from socketserver import ThreadingTCPServer, BaseRequestHandler
+
+if __name__ == '__main__':
+	from basex import Session
+else:
+	from .basex import Session
+
+
+class Recorder:
+	"""
+	Writes the traffic of the attached sessions to a file. Events are appended as they happen:
+	track number, direction (`>` sent, `<` received), time since the connection was opened, data.
+	"""
+	
+	magic = b'BaseX recording 1\n'
+	header = struct.Struct('<IcdQ')
+	
+	class SocketWrapper(Session.SocketWrapper):
+		"Socket wrapper that reports every write and read to the recorder."
+		
+		def __init__(self, recorder, *args):
+			super().__init__(*args)
+			self.recorder = recorder
+			self.recorded = 0
+		
+		def open(self):
+			super().open()
+			self.track = self.recorder.new_track()
+			self.opened = perf_counter()
+		
+		def fill(self):
+			super().fill()
+			n = self.received - self.recorded
+			data = bytes(self.in_buffer.view[self.in_buffer.tail - n:self.in_buffer.tail])
+			self.recorder.write(self.track, b'<', perf_counter() - self.opened, data)
+			self.recorded = self.received
+		
+		def flush(self, receive=False):
+			data = bytes(self.out_buffer)
+			if data:
+				self.recorder.write(self.track, b'>', perf_counter() - self.opened, data) # before the replies that may arrive while sending
+			super().flush(receive)
+	
+	def __init__(self, path):
+		self.file = open(path, 'wb')
+		self.file.write(self.magic)
+		self.tracks = count()
+		self.lock = Lock()
+	
+	def new_track(self):
+		with self.lock:
+			return next(self.tracks)
+	
+	def write(self, track, direction, time, data):
+		with self.lock:
+			self.file.write(self.header.pack(track, direction, time, len(data)))
+			self.file.write(data)
+	
+	def attach(self, session):
+		"Record the connections the session opens from now on. The session must not be connected yet."
+		session.SocketWrapper = lambda *args: self.SocketWrapper(self, *args)
+		return session
+	
+	def close(self):
+		self.file.close()
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *args):
+		self.close()
+
+
+class Recording:
+	"""
+	Recording loaded from a file. `tracks` is the list of connections; a track is a list of exchanges `(request, response)`,
+	where `request` is the bytes sent by the client (empty for the server greeting) and `response` a list of `(delay, data)`,
+	the delay counted from the previous event of the connection.
+	"""
+	
+	def __init__(self, path):
+		events = {}
+		with open(path, 'rb') as file_:
+			if file_.read(len(Recorder.magic)) != Recorder.magic:
+				raise ValueError(f"Not a BaseX recording: {path}")
+			while header := file_.read(Recorder.header.size):
+				track, direction, time, length = Recorder.header.unpack(header)
+				events.setdefault(track, []).append((direction, time, file_.read(length)))
+		
+		self.tracks = [self.exchanges(events[_track]) for _track in sorted(events)]
+	
+	@staticmethod
+	def exchanges(events):
+		"Group the events of one connection into exchanges: requests sent in a row, then responses received in a row."
+		exchanges = []
+		request = []
+		response = None
+		last = 0.0
+		for direction, time, data in events:
+			if direction == b'>':
+				if response is not None:
+					exchanges.append((b''.join(request), response))
+					request = []
+					response = None
+				request.append(data)
+			else:
+				if response is None:
+					response = []
+				response.append((time - last, data))
+			last = time
+		if response is not None:
+			exchanges.append((b''.join(request), response))
+		return exchanges
+
+
+class ReplayServer:
+	"""
+	Local TCP server replaying a `Recording` (or a recording file). Requests are matched byte by byte: the next one in the recorded order
+	first, then any other not replayed yet. `speed` scales the recorded delays (2 is twice as fast), `None` sends the responses at once.
+	A connection sending a request that is not in its track is closed.
+	"""
+	
+	class Server(ThreadingTCPServer):
+		daemon_threads = True
+		allow_reuse_address = True
+		
+		def __init__(self, address, family, replay):
+			self.address_family = family
+			self.replay = replay
+			super().__init__(address, ReplayServer.Handler)
+	
+	class Handler(BaseRequestHandler):
+		def handle(self):
+			self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # responses are replayed in parts, do not let them wait for ACKs
+			self.server.replay.serve(self.request)
+	
+	def __init__(self, recording, address=('::1', 0), family=socket.AF_INET6, speed=1.0):
+		if not isinstance(recording, Recording):
+			recording = Recording(recording)
+		self.recording = recording
+		self.speed = speed
+		self.connections = count()
+		self.server = self.Server(address, family, self)
+		self.thread = None
+	
+	@property
+	def address(self):
+		return self.server.server_address[:2]
+	
+	def start(self):
+		"Serve in a background thread."
+		self.thread = Thread(target=self.server.serve_forever, daemon=True)
+		self.thread.start()
+	
+	def close(self):
+		if self.thread is not None:
+			self.server.shutdown()
+			self.thread = None
+		self.server.server_close()
+	
+	def __enter__(self):
+		self.start()
+		return self
+	
+	def __exit__(self, *args):
+		self.close()
+	
+	def serve(self, sock):
+		"Replay the next track to the connected socket."
+		tracks = self.recording.tracks
+		track = tracks[next(self.connections) % len(tracks)]
+		replayed = [False] * len(track)
+		position = 0
+		received = bytearray()
+		
+		while True:
+			while position < len(track) and replayed[position]:
+				position += 1
+			
+			index = None
+			if position < len(track) and received.startswith(track[position][0]):
+				index = position
+			elif received:
+				for n, (request, response) in enumerate(track):
+					if request and not replayed[n] and received.startswith(request):
+						index = n
+						break
+			
+			if index is None:
+				if received and not any(_request.startswith(received) for (_request, _response), _replayed in zip(track, replayed) if not _replayed):
+					log.error(f"Request not in the recording, closing connection: {bytes(received[:64])}")
+					return
+				data = sock.recv(1 << 16)
+				if not data:
+					return
+				received += data
+				continue
+			
+			request, response = track[index]
+			replayed[index] = True
+			del received[:len(request)]
+			if self.speed:
+				for delay, data in response:
+					if delay > 0:
+						sleep(delay / self.speed)
+					sock.sendall(data)
+			else:
+				sock.sendall(b''.join(_data for _delay, _data in response))
+
+
+if __debug__ and __name__ == '__main__':
+	import os
+	from tempfile import TemporaryDirectory
+	from fakeserver import FakeServer
+	
+	def work(session):
+		"Requests recorded and replayed, returning everything the server answered."
+		answers = [session.execute.info()]
+		with session.query('1 to 10') as query:
+			answers.append(list(query.results()))
+			for n in range(3):
+				with session.pipeline():
+					query.bind('$n', n)
+					reply = query.execute()
+				answers.append(reply.result())
+		return answers
+	
+	with TemporaryDirectory() as directory:
+		path = os.path.join(directory, 'basex.rec')
+		with FakeServer(query=lambda _text, _bindings, _context: [_text] + [_value for (_value, _type) in _bindings.values()], command=lambda _text: 'info') as server:
+			with Recorder(path) as recorder:
+				with recorder.attach(Session('admin', 'admin', server.address)) as session:
+					recorded = work(session)
+		
+		with ReplayServer(path, speed=None) as server:
+			start = perf_counter()
+			with Session('admin', 'admin', server.address) as session:
+				assert work(session) == recorded
+			print(f"replay: ok, {perf_counter() - start:.6f}s")